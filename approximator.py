@@ -0,0 +1,245 @@
+import random
+
+import numpy as np
+
+from azul import Azul, PlayerBoard, COUNT_BITS, COUNT_MASK, START_PLAYER_BIT, FLOOR_PENALTIES, FLOOR_LINE_SIZE
+
+# Layout of the feature vector of a state and action, every feature is scaled to about [-1, 1]
+WALL_FEATURES = slice(0, 25)            # wall occupancy bits of the player to move
+PILE_FEATURES = slice(25, 30)           # how full every pile is
+FLOOR_FEATURE = 30                      # floor penalty so far
+FACTORY_FEATURES = slice(31, 36)        # tiles per color left on the factories and the floor
+START_TILE_FEATURE = 36                 # whether the start player tile is still on the floor
+SCORE_FEATURE = 37                      # score minus the best score of the opponents
+COLOR_FEATURES = slice(38, 43)          # color taken
+PILE_CHOICE_FEATURES = slice(43, 49)    # pile the tiles go to, the last one is the floor line
+TAKEN_FEATURE = 49                      # number of tiles taken
+OVERFLOW_FEATURE = 50                   # number of tiles that end up on the floor line
+TAKES_START_FEATURE = 51                # whether the start player tile is taken
+COMPLETES_FEATURE = 52                  # whether the pile is full after the move
+GAIN_FEATURE = 53                       # points of the tile that goes on the wall minus the extra floor penalty
+BIAS_FEATURE = 54
+NUM_FEATURES = 55
+
+CAPACITY = np.array([1, 2, 3, 4, 5, 0])
+FLOOR_PENALTY_TABLE = np.array(FLOOR_PENALTIES)
+WALL_BITS = np.arange(25)
+
+def tile_counts(tiles):
+    """
+    Unpacks a packed tile count vector into a numpy array of counts per color
+    """
+    return np.array([(tiles >> (color * COUNT_BITS)) & COUNT_MASK for color in Azul.COLORS])
+
+def state_features(state):
+    """
+    Returns the features of 'state' that are the same for every action, from the point of view of the player to move,
+    and the unpacked board, factory tiles and floor tiles the action features are computed from.
+    """
+    player, difficulty, factories, floor, boards = state
+    board = PlayerBoard.from_key(difficulty, boards[player])
+    # Row 0 is the floor, row 'i + 1' is factory 'i', like the factory index of an action + 1
+    tiles = np.array([tile_counts(floor & ~START_PLAYER_BIT)] + [tile_counts(factory) for factory in factories])
+
+    features = np.zeros(NUM_FEATURES)
+    features[WALL_FEATURES] = (board.occupied >> WALL_BITS) & 1
+    features[PILE_FEATURES] = [board.pile(p)[1] / (p + 1) for p in range(5)]
+    features[FLOOR_FEATURE] = board.floor_penalty() / 14
+    features[FACTORY_FEATURES] = tiles.sum(axis=0) / 20
+    features[START_TILE_FEATURE] = floor & START_PLAYER_BIT != 0
+    opponents = [key[-1] for p, key in enumerate(boards) if p != player]
+    features[SCORE_FEATURE] = (board.score - max(opponents)) / 50
+    features[BIAS_FEATURE] = 1
+    return features, board, tiles
+
+def action_features(state, actions=None):
+    """
+    Returns the available actions of 'state' (or the given 'actions') and their feature vectors as the rows of a matrix
+    """
+    if actions is None:
+        actions = Azul.state_actions(state)
+    features, board, tiles = state_features(state)
+    matrix = np.tile(features, (len(actions), 1))
+    if not actions:
+        return actions, matrix
+
+    colors, factories, piles = np.array(actions).T
+    rows = np.arange(len(actions))
+    taken = tiles[factories + 1, colors]
+    takes_start = (factories == Azul.FLOOR) & (state[3] & START_PLAYER_BIT != 0)
+
+    pile_counts = np.array([board.pile(p)[1] for p in range(5)] + [0])
+    placed = np.minimum(taken, CAPACITY[piles] - pile_counts[piles])
+    overflow = taken - placed + takes_start
+    completes = (piles < Azul.FLOOR_LINE) & (pile_counts[piles] + placed == CAPACITY[piles])
+
+    # Points of the tile that goes on the wall when the pile is full
+    wall_points = np.zeros(len(actions))
+    occupied = board.occupied
+    for i in np.flatnonzero(completes):
+        # Board methods get Python ints, the wall of difficulty 1 has more bits than a numpy int
+        row, color = int(piles[i]), int(colors[i])
+        column = board.column_for_color(row, color)
+        if column < 0:
+            # No column left for the color: the tiles go to the lid without points
+            continue
+        board.occupied = occupied | 1 << (row * 5 + column)
+        wall_points[i] = board.tile_score(row, column)
+        board.occupied = occupied
+
+    fouls = board.foul_count()
+    penalty = FLOOR_PENALTY_TABLE[np.minimum(fouls + overflow, FLOOR_LINE_SIZE)] - FLOOR_PENALTY_TABLE[fouls]
+
+    matrix[rows, COLOR_FEATURES.start + colors] = 1
+    matrix[rows, PILE_CHOICE_FEATURES.start + piles] = 1
+    matrix[:, TAKEN_FEATURE] = taken / 5
+    matrix[:, OVERFLOW_FEATURE] = overflow / FLOOR_LINE_SIZE
+    matrix[:, TAKES_START_FEATURE] = takes_start
+    matrix[:, COMPLETES_FEATURE] = completes
+    matrix[:, GAIN_FEATURE] = (wall_points + penalty) / 10
+    return actions, matrix
+
+class ReplayMemory():
+
+    def __init__(self, capacity, num_features=NUM_FEATURES):
+        """
+        Ring buffer of transitions kept in preallocated arrays, so it uses the same memory however long it is used:
+            - 'features': features of the state and the action that was taken
+            - 'rewards': the reward for the action
+            - 'next_features': features of the best action in the new state, when it was stored
+            - 'done': whether the new state has no actions left
+        When it is full, a new transition replaces the oldest one.
+        """
+        self.capacity = capacity
+        self.features = np.zeros((capacity, num_features))
+        self.rewards = np.zeros(capacity)
+        self.next_features = np.zeros((capacity, num_features))
+        self.done = np.zeros(capacity, dtype=bool)
+        self.position = 0
+        self.size = 0
+
+    def add(self, features, reward, next_features, done):
+        i = self.position
+        self.features[i] = features
+        self.rewards[i] = reward
+        self.next_features[i] = next_features
+        self.done[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size, rng):
+        """
+        Returns 'batch_size' random transitions as '(features, rewards, next_features, done)' arrays
+        """
+        i = rng.integers(0, self.size, batch_size)
+        return self.features[i], self.rewards[i], self.next_features[i], self.done[i]
+
+    def __len__(self):
+        return self.size
+
+class LinearAI():
+
+    def __init__(self, alpha=0.01, epsilon=0.1, gamma=1.0, seed=None, memory_size=10000, batch_size=32):
+        """
+        AI that approximates the Q-value of a state and action as the dot product of
+        their feature vector and a weight vector, instead of storing a Q-value per state like 'NimAI'.
+
+        Every update stores the transition in a replay memory of 'memory_size' transitions
+        and moves the weights towards the TD targets of a random batch of 'batch_size' transitions:
+
+        w <- w + alpha * mean((reward + gamma * max Q(new state) - Q(s, a)) * features(s, a))
+
+        It can be used everywhere a 'NimAI' is used: 'choose_action()', 'update()', 'self_play()' and 'train(player=...)'.
+        """
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.gamma = gamma
+        self.batch_size = batch_size
+        self.weights = np.zeros(NUM_FEATURES)
+        self.memory = ReplayMemory(memory_size)
+        self.rng = random.Random(seed)
+        self.sample_rng = np.random.default_rng(seed)
+
+    def save(self, path):
+        np.save(path, self.weights)
+
+    @classmethod
+    def load(cls, path, alpha=0.01, epsilon=0.1, seed=None):
+        player = cls(alpha, epsilon, seed=seed)
+        player.weights = np.load(path)
+        return player
+
+    def q_values(self, state):
+        """
+        Returns the available actions of 'state' and their Q-values
+        """
+        actions, features = action_features(state)
+        return actions, features @ self.weights
+
+    def get_q_value(self, state, action):
+        actions, features = action_features(state, [action])
+        return features[0] @ self.weights
+
+    def update(self, old_state, action, new_state, reward):
+        """
+        Store the transition in the replay memory and learn from a batch of stored transitions
+        """
+        actions, features = action_features(old_state, [action])
+        next_actions, next_features = action_features(new_state)
+        if next_actions:
+            best = next_features[np.argmax(next_features @ self.weights)]
+        else:
+            best = np.zeros(NUM_FEATURES)
+        self.memory.add(features[0], reward, best, not next_actions)
+
+        if len(self.memory) >= self.batch_size:
+            self.learn()
+
+    def learn(self):
+        """
+        One TD update of the weights from a random batch of the replay memory
+        """
+        features, rewards, next_features, done = self.memory.sample(self.batch_size, self.sample_rng)
+        targets = rewards + self.gamma * (next_features @ self.weights) * ~done
+        errors = targets - features @ self.weights
+        self.weights += self.alpha * (errors @ features) / self.batch_size
+
+    def choose_action(self, state, epsilon=True):
+        """
+        Given a state 'state', return an action '(i, j, k)' to take: with probability 'self.epsilon'
+        a random available action if 'epsilon' is True, otherwise the action with the highest Q-value.
+        """
+        epsilon_to_use = self.epsilon if epsilon else 0
+        if self.rng.random() >= epsilon_to_use:
+            return self.get_best_action(state)
+        else:
+            return self.get_random_action(state)
+
+    def get_best_action(self, state):
+        actions, values = self.q_values(state)
+        if not actions:
+            return None
+        return actions[int(np.argmax(values))]
+
+    def get_random_action(self, state):
+        return self.rng.choice(list(Azul.state_actions(state)))
+
+    def choose_move(self, game):
+        """
+        Return the best action in the position of 'game'
+        """
+        return self.choose_action(game.state(), epsilon=False)
+
+    def best_actions(self, states):
+        """
+        Returns the best action of every state in 'states', all Q-values are computed with one matrix multiply
+        """
+        batches = [action_features(state) for state in states]
+        values = np.concatenate([features for actions, features in batches]) @ self.weights
+        result = []
+        start = 0
+        for actions, features in batches:
+            end = start + len(actions)
+            result.append(actions[int(np.argmax(values[start:end]))] if actions else None)
+            start = end
+        return result
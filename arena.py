@@ -0,0 +1,251 @@
+import argparse
+import itertools
+import math
+import multiprocessing
+import random
+
+from azul import Azul
+
+class RandomPlayer():
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def choose_move(self, game):
+        return self.rng.choice(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+
+class GreedyPlayer():
+
+    def __init__(self, seed=None):
+        """
+        Plays the move with the highest 'Azul.immediate_gain()', ties are broken at random
+        """
+        self.rng = random.Random(seed)
+
+    def choose_move(self, game):
+        actions = Azul.pruned_actions(game.boards[game.player], game.factories, game.floor)
+        gains = [game.immediate_gain(action) for action in actions]
+        best = max(gains)
+        return self.rng.choice([action for action, gain in zip(actions, gains) if gain == best])
+
+def play_game(agents, seating, seed, num_players):
+    """
+    Plays one game of Azul with seed 'seed' where seat 'i' is played by the agent named 'seating[i]'.
+    Agents with a random generator 'rng' get a seed that only depends on the game and the seat,
+    so a game gives the same result in any process.
+    Returns the seating, the final score of every seat and the ranking key '(score, complete rows)' of every seat.
+    """
+    for seat, name in enumerate(seating):
+        agent = agents[name]
+        if hasattr(agent, "rng"):
+            agent.rng.seed(seed * 4 + seat)
+    game = Azul(num_players, seed=seed)
+    while game.winner is None:
+        game.move(agents[seating[game.player]].choose_move(game))
+    keys = [(board.score, board.complete_rows()) for board in game.boards]
+    return seating, [board.score for board in game.boards], keys
+
+class RunningMean():
+
+    def __init__(self):
+        """
+        Mean and variance of a stream of values (Welford's algorithm)
+        """
+        self.count = 0
+        self.mean = 0.0
+        self.squares = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+
+    def interval(self, z):
+        """
+        Returns the confidence interval of the mean for a normal quantile 'z'
+        """
+        if self.count < 2:
+            return -math.inf, math.inf
+        error = z * math.sqrt(self.squares / (self.count - 1) / self.count)
+        return self.mean - error, self.mean + error
+
+def elo(fraction):
+    """
+    Returns the Elo difference that gives an expected score of 'fraction'
+    """
+    fraction = min(max(fraction, 1e-6), 1 - 1e-6)
+    return 400 * math.log10(fraction / (1 - fraction))
+
+class Arena():
+
+    def __init__(self, agents, num_players=2, workers=1, seed=0, z=2.58, min_games=100, batch_size=10):
+        """
+        Plays seeded games of Azul between the agents of the dict 'agents' ('name: agent' with a 'choose_move(game)' method).
+
+        Games are scheduled in rounds: every round plays every combination of 'num_players' agents,
+        and every combination in all rotations of its seats, all with the same seed.
+        With more than 1 worker the games are played by a pool of 'workers' processes, in batches of 'batch_size' games.
+        Results are counted in the order of the schedule, so the outcome doesn't depend on timing.
+        Agents that search with processes of their own, like an 'MCTSPlayer' with workers, can't be used with workers.
+
+        Every game counts as a match between every two seats: the better ranked seat scores 1, a tie 0.5.
+        The Elo of an agent is its performance against the field: the Elo difference that gives its average score.
+        The score margin of an agent is its score minus the average score of its opponents.
+        Both come with a confidence interval for the normal quantile 'z'. 'z' is wider than the usual 1.96,
+        because the intervals are checked after every game.
+        """
+        if len(agents) < num_players:
+            raise ValueError("Need at least as many agents as players")
+        self.agents = agents
+        self.num_players = num_players
+        self.workers = workers
+        self.seed = seed
+        self.z = z
+        self.min_games = min_games
+        self.batch_size = batch_size
+        self.games = 0
+        self.points = dict.fromkeys(agents, 0.0)
+        self.matches = dict.fromkeys(agents, 0)
+        self.wins = dict.fromkeys(agents, 0)
+        self.margins = {name: RunningMean() for name in agents}
+
+    def schedule(self):
+        """
+        Yields '(seating, seed)' of every game, without end
+        """
+        combinations = list(itertools.combinations(self.agents, self.num_players))
+        for round_number in itertools.count():
+            for c, combination in enumerate(combinations):
+                seed = self.seed + round_number * len(combinations) + c
+                for rotation in range(self.num_players):
+                    yield combination[rotation:] + combination[:rotation], seed
+
+    def record(self, result):
+        """
+        Adds the result of a game returned by 'play_game()'
+        """
+        seating, scores, keys = result
+        self.games += 1
+        self.wins[seating[max(range(len(keys)), key=lambda seat: keys[seat])]] += 1
+        for a, b in itertools.combinations(range(len(seating)), 2):
+            points = 1.0 if keys[a] > keys[b] else 0.5 if keys[a] == keys[b] else 0.0
+            self.points[seating[a]] += points
+            self.points[seating[b]] += 1 - points
+            self.matches[seating[a]] += 1
+            self.matches[seating[b]] += 1
+        for seat, name in enumerate(seating):
+            opponents = [score for other, score in enumerate(scores) if other != seat]
+            self.margins[name].add(scores[seat] - sum(opponents) / len(opponents))
+
+    def elo_interval(self, name):
+        """
+        Returns the Elo of an agent and its confidence interval
+        """
+        matches = self.matches[name]
+        if not matches:
+            return 0.0, -math.inf, math.inf
+        fraction = self.points[name] / matches
+        error = self.z * math.sqrt(max(fraction * (1 - fraction), 0.25 / matches) / matches)
+        return elo(fraction), elo(fraction - error), elo(fraction + error)
+
+    def standings(self):
+        """
+        Returns a dict per agent, from the highest to the lowest Elo
+        """
+        rows = []
+        for name in self.agents:
+            rating, low, high = self.elo_interval(name)
+            margin_low, margin_high = self.margins[name].interval(self.z)
+            rows.append({
+                "name": name,
+                "games": self.margins[name].count,
+                "wins": self.wins[name],
+                "elo": rating,
+                "elo_low": low,
+                "elo_high": high,
+                "margin": self.margins[name].mean,
+                "margin_low": margin_low,
+                "margin_high": margin_high,
+            })
+        rows.sort(key=lambda row: row["elo"], reverse=True)
+        return rows
+
+    def is_significant(self):
+        """
+        Returns whether the Elo intervals of every two agents next to each other in the standings don't overlap
+        """
+        if self.games < self.min_games:
+            return False
+        rows = self.standings()
+        return all(better["elo_low"] > worse["elo_high"] for better, worse in zip(rows, rows[1:]))
+
+    def run(self, max_games, callback=None):
+        """
+        Plays at most 'max_games' games, stopping early when the standings are significant.
+        'callback' is called with the arena after every game. Returns the standings.
+        """
+        games = itertools.islice(self.schedule(), max_games)
+        if self.workers > 1:
+            with multiprocessing.Pool(self.workers, initializer=_init_arena_worker,
+                                      initargs=(self.agents, self.num_players)) as pool:
+                self.record_results(pool.imap(_play_arena_game, games, self.batch_size), callback)
+        else:
+            results = (play_game(self.agents, seating, seed, self.num_players) for seating, seed in games)
+            self.record_results(results, callback)
+        return self.standings()
+
+    def record_results(self, results, callback):
+        for result in results:
+            self.record(result)
+            if callback is not None:
+                callback(self)
+            if self.is_significant():
+                break
+
+_worker_agents = None
+_worker_num_players = None
+
+def _init_arena_worker(agents, num_players):
+    global _worker_agents, _worker_num_players
+    _worker_agents = agents
+    _worker_num_players = num_players
+
+def _play_arena_game(game):
+    seating, seed = game
+    return play_game(_worker_agents, seating, seed, _worker_num_players)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plays Azul agents against each other")
+    parser.add_argument("agents", nargs="+", choices=["random", "greedy", "mcts", "nimai"])
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--qtable", default="azul.qtable", help="Q-table file of the nimai agent")
+    args = parser.parse_args(argv)
+
+    agents = {}
+    for i, kind in enumerate(args.agents):
+        # The same kind of agent can play more than once
+        name = kind if args.agents.count(kind) == 1 else f"{kind}{i}"
+        if kind == "random":
+            agents[name] = RandomPlayer()
+        elif kind == "greedy":
+            agents[name] = GreedyPlayer()
+        elif kind == "mcts":
+            from mcts import MCTSPlayer
+            agents[name] = MCTSPlayer(iterations=200)
+        elif kind == "nimai":
+            from azul import NimAI
+            agents[name] = NimAI.load(args.qtable)
+
+    arena = Arena(agents, args.players, args.workers, args.seed)
+    for row in arena.run(args.games):
+        print(f"{row['name']:8} {row['games']:6} games {row['wins']:6} wins "
+              f"Elo {row['elo']:7.1f} [{row['elo_low']:7.1f}, {row['elo_high']:7.1f}] "
+              f"margin {row['margin']:6.1f} [{row['margin_low']:6.1f}, {row['margin_high']:6.1f}]")
+    print(f"{arena.games} games played")
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,95 @@
+import array
+import bisect
+import collections
+import hashlib
 import math
+import mmap
+import multiprocessing
+import os
+import pickle
 import random
+import struct
+import tempfile
 import time
 import sys
 
-random.seed(0)
+# Factory and floor contents are count vectors packed 5 bits per color: the count of color c is
+# stored at bit 'c * 5'. 5 bits are enough for all 20 tiles of a color to end up on the floor.
+COUNT_BITS = 5
+COUNT_MASK = 0b11111
+# Bit above the 5 counts that marks the start player tile in 'TileFactory.key()'
+START_PLAYER_BIT = 1 << 25
 
 class TileFactory():
-    def __init__(self, is_floor = False):
+    __slots__ = ("tiles", "is_floor", "start_player")
+
+    def __init__(self, is_floor = False, bag = None):
         """
         Initializes a set of tiles
         Consists of:
-        - maximum 4 tiles
+        - maximum 4 tiles, stored as a packed count per color
         - any tile can be of either color
+        - the floor also holds the start player tile until someone takes tiles from it
         """
-        self.tiles = []
+        self.tiles = 0
         self.is_floor = is_floor
+        self.start_player = False
 
-        self.produce_tiles()
+        self.produce_tiles(bag)
 
-    def produce_tiles(self):
+    def produce_tiles(self, bag = None):
         """
-        Produces 4 tiles
+        Produces 4 tiles drawn from 'bag' (fewer if the bag and the lid run out of tiles)
         """
+        self.tiles = 0
         if not self.is_floor:
-            self.tiles = random.choices([Azul.BLUE, Azul.RED, Azul.YELLOW, Azul.WHITE, Azul.BLACK], k=4)
+            if bag is not None:
+                self.tiles = bag.draw_tiles(4)
         else:
-            self.tiles = [Azul.START_PLAYER_TILE]
+            self.start_player = True
+
+    def key(self):
+        return self.tiles | START_PLAYER_BIT if self.start_player else self.tiles
+
+    def restore(self, key):
+        """
+        Sets the contents back to a value returned by 'key()'
+        """
+        self.tiles = key & ~START_PLAYER_BIT
+        self.start_player = key & START_PLAYER_BIT != 0
+
+    def count(self, color):
+        return (self.tiles >> (color * COUNT_BITS)) & COUNT_MASK
+
+    def colors(self):
+        """
+        Returns the colors of which there is at least one tile
+        """
+        tiles = self.tiles
+        return [color for color in Azul.COLORS if (tiles >> (color * COUNT_BITS)) & COUNT_MASK]
+
+    def tile_count(self):
+        tiles = self.tiles
+        total = 0
+        while tiles:
+            total += tiles & COUNT_MASK
+            tiles >>= COUNT_BITS
+        return total
 
     def has_tiles(self):
-        return len(self.tiles)
+        return self.tiles != 0
 
-    def take_tiles(self, color):
+    def take_tiles(self, color, floor = None):
         """
         Takes all tiles of the given color. Returns the number of tiles of that color.
+        When taking from a factory, the remaining tiles are pushed to 'floor'.
         """
-        result = self.tiles.count(color)
-        self.tiles.remove(color)
+        shift = color * COUNT_BITS
+        result = (self.tiles >> shift) & COUNT_MASK
+        self.tiles &= ~(COUNT_MASK << shift)
+        if floor is not None and not self.is_floor:
+            floor.tiles += self.tiles
+            self.tiles = 0
         return result
 
     def drop_tiles_on_floor(self, color, num):
@@ -44,36 +98,228 @@ class TileFactory():
         """
         if not self.is_floor:
             raise TypeError("This factory is not the floor and tiles can't be added to it!")
-        self.tiles += [color]*num
+        self.tiles += num << (color * COUNT_BITS)
 
     def __str__(self):
-        return "".join(self.tiles)
+        result = Azul.SYMBOLS[Azul.START_PLAYER_TILE] if self.start_player else ""
+        return result + "".join(Azul.SYMBOLS[color] * self.count(color) for color in Azul.COLORS)
     def __repr__(self):
         return self.__str__()
 
+class TileBag():
+    __slots__ = ("bag", "bag_size", "lid", "lid_size", "rng")
+
+    TILES_PER_COLOR = 20
+
+    def __init__(self, rng):
+        """
+        Initializes the bag with 20 tiles of every color and an empty box lid
+        Both are packed count vectors like the factories. 'rng' is the random.Random of the game,
+        so that every game draws its tiles from its own stream.
+        """
+        self.bag = sum(TileBag.TILES_PER_COLOR << (color * COUNT_BITS) for color in Azul.COLORS)
+        self.bag_size = TileBag.TILES_PER_COLOR * len(Azul.COLORS)
+        self.lid = 0
+        self.lid_size = 0
+        self.rng = rng
+
+    def count(self, color):
+        return (self.bag >> (color * COUNT_BITS)) & COUNT_MASK
+
+    def lid_count(self, color):
+        return (self.lid >> (color * COUNT_BITS)) & COUNT_MASK
+
+    def draw(self):
+        """
+        Draws a single tile from the bag, weighted by the number of tiles of each color.
+        When the bag is empty, it is refilled with the tiles from the lid first.
+        Returns the color, or -1 if there are no tiles left in both the bag and the lid.
+        """
+        if self.bag_size == 0:
+            if self.lid_size == 0:
+                return -1
+            self.bag, self.bag_size = self.lid, self.lid_size
+            self.lid, self.lid_size = 0, 0
+
+        r = self.rng.randrange(self.bag_size)
+        bag = self.bag
+        color = 0
+        while True:
+            r -= bag & COUNT_MASK
+            if r < 0:
+                break
+            bag >>= COUNT_BITS
+            color += 1
+        self.bag -= 1 << (color * COUNT_BITS)
+        self.bag_size -= 1
+        return color
+
+    def draw_tiles(self, num):
+        """
+        Draws 'num' tiles and returns them as a packed count vector
+        """
+        tiles = 0
+        for i in range(num):
+            color = self.draw()
+            if color < 0:
+                break
+            tiles += 1 << (color * COUNT_BITS)
+        return tiles
+
+    def discard(self, color, num):
+        """
+        Puts tiles in the box lid
+        """
+        self.lid += num << (color * COUNT_BITS)
+        self.lid_size += num
+
+# The wall is stored as bitboards. Cell (row, column) is bit 'row * 5 + column'
+# of the 25-bit occupancy mask, and the colors are stored as 5 such planes packed
+# into a single int: cell (row, column) of color c is bit 'c * 25 + row * 5 + column'.
+ROW_MASKS = [0b11111 << (row * 5) for row in range(5)]
+COLUMN_MASKS = [sum(1 << (row * 5 + column) for row in range(5)) for column in range(5)]
+FULL_WALL = (1 << 25) - 1
+# Cells of every color on the standard wall (difficulty 0), color c goes in column '(c + row) % 5'
+COLOR_MASKS = [sum(1 << (row * 5 + (color + row) % 5) for row in range(5)) for color in range(5)]
+
+# Scoring tables
+# RUN_SCORE[bits][i] is the length of the run of set bits through bit i of a 5-bit line, or 0 for a run of 1.
+# A placed tile scores the runs of its row and its column, or 1 point if it has no neighbours at all.
+def _run_length(bits, i):
+    start = i
+    while start > 0 and bits >> (start - 1) & 1:
+        start -= 1
+    end = i
+    while end < 4 and bits >> (end + 1) & 1:
+        end += 1
+    return end - start + 1
+RUN_SCORE = [[(_run_length(bits, i) if bits >> i & 1 and _run_length(bits, i) > 1 else 0) for i in range(5)]
+             for bits in range(32)]
+# Multiplying the bits of column 0 (bits 0, 5, 10, 15, 20) by COLUMN_GATHER moves bit '5 * row' to bit '20 + row'
+COLUMN_GATHER = sum(1 << (20 - 4 * row) for row in range(5))
+# Penalty for the number of tiles on the floor line
+FLOOR_PENALTIES = [0, -1, -2, -4, -6, -8, -11, -14]
+ROW_BONUS = 2
+COLUMN_BONUS = 7
+COLOR_BONUS = 10
+
+# Piles are packed 6 bits per pile: 3 bits for the count, 3 bits for the color
+PILE_BITS = 6
+PILE_MASK = 0b111111
+
+# Foul tiles are packed 3 bits per field: the total count first, then one count per tile kind
+FLOOR_LINE_SIZE = 7
+
+# The piles that can receive a color are kept as a 5x5 mask laid out like the wall: bit 'color * 5 + pile'.
+# SPREAD_COLORS turns a 5-bit set of colors into the bits of pile 0 of those colors,
+# PILES_FOR_MASK turns the 5-bit set of piles of a color into a list of pile numbers.
+SPREAD_COLORS = [sum(1 << (color * 5) for color in range(5) if colors >> color & 1) for colors in range(32)]
+PILES_FOR_MASK = [[pile for pile in range(5) if piles >> pile & 1] for piles in range(32)]
+
 class PlayerBoard():
+    __slots__ = ("difficulty", "wall", "occupied", "row_colors", "receivable", "piles", "foul_tiles", "score")
+
     def __init__(self, difficulty = 0):
         """
         Initializes a player's board
         Consists of:
-        - a 5x5 2D wall
-        - 1, 2, 3, 4, 5 wait piles that allow you to save tiles for use on the wall
+        - a 5x5 2D wall, stored as color bitboards ('wall') and an occupancy bitboard ('occupied')
+        - the colors on every line of the wall ('row_colors', bit 'row * 5 + color')
+        - 1, 2, 3, 4, 5 wait piles that allow you to save tiles for use on the wall, packed into one int
+        - the piles that can receive every color ('receivable', bit 'color * 5 + pile'), kept up to date on every change
         - difficulty: 0 for standard tile board, 1 for no predefined colors allowed on the board
-        - foul tiles: tiles that are too many
+        - foul tiles: tiles that are too many, packed into one int
         """
-        self.wall = [[Azul.EMPTY]*5 for i in range(5)]
-        self.allowed_colors = [[Azul.EMPTY]*5 for i in range(5)]
-        self.piles = {i:{"color": Azul.EMPTY, "count" :0} for i in range(5)}
         self.difficulty = difficulty
-        self.foul_tiles = []
+        self.wall = 0
+        self.occupied = 0
+        self.row_colors = 0
+        self.receivable = FULL_WALL
+        self.piles = 0
+        self.foul_tiles = 0
         self.score = 0
-        
-        color_array = [Azul.BLUE, Azul.YELLOW, Azul.RED, Azul.BLACK, Azul.WHITE]
-        # Initialize the board allowed colors
+
+    def pile(self, pileNumber):
+        """
+        Returns '(color, count)' of the given pile, color is Azul.EMPTY if the pile has no tiles
+        """
+        pile = (self.piles >> (pileNumber * PILE_BITS)) & PILE_MASK
+        count = pile & 0b111
+        if count == 0:
+            return (Azul.EMPTY, 0)
+        return (pile >> 3, count)
+
+    def has_color_in_row(self, row, color):
+        return self.row_colors >> (row * 5 + color) & 1 != 0
+
+    def update_receivable(self, pileNumber):
+        """
+        Recomputes which colors pile 'pileNumber' can receive
+        """
+        pile = (self.piles >> (pileNumber * PILE_BITS)) & PILE_MASK
+        count = pile & 0b111
+        if count == 0:
+            colors = ~(self.row_colors >> (pileNumber * 5)) & 0b11111
+        elif count < pileNumber + 1:
+            colors = 1 << (pile >> 3)
+        else:
+            colors = 0
+        self.receivable = (self.receivable & ~COLUMN_MASKS[pileNumber]) | (SPREAD_COLORS[colors] << pileNumber)
+
+    def receivable_piles(self, color):
+        """
+        Returns the piles that can receive the given color as a 5-bit mask
+        """
+        return (self.receivable >> (color * 5)) & 0b11111
+
+    def column_for_color(self, row, color):
+        """
+        Returns the column on the wall where 'color' goes in line 'row', or -1 if it can't be placed.
+        On the standard board (difficulty 0) every color has a fixed spot.
+        Without predefined colors (difficulty 1) the leftmost free column that doesn't have this color yet is used.
+        """
         if self.difficulty == 0:
-            for i in range(5):
-                self.allowed_colors[i] = color_array
-                color_array.insert(0, color_array.pop(-1))
+            column = (color + row) % 5
+            if self.occupied >> (row * 5 + column) & 1:
+                return -1
+            return column
+        plane = self.wall >> (color * 25)
+        for column in range(5):
+            if not self.occupied >> (row * 5 + column) & 1 and not plane & COLUMN_MASKS[column]:
+                return column
+        return -1
+
+    def place_on_wall(self, row, color, column = None):
+        """
+        Puts a tile of the given color on the wall and returns the column it was put in
+        """
+        if column is None:
+            column = self.column_for_color(row, color)
+            if column < 0:
+                raise ValueError(f"Color can't be placed on the wall at line {row}")
+        bit = row * 5 + column
+        self.occupied |= 1 << bit
+        self.wall |= 1 << (color * 25 + bit)
+        self.row_colors |= 1 << (row * 5 + color)
+        self.update_receivable(row)
+        return column
+
+    def wall_color(self, row, column):
+        """
+        Returns the color on the wall at (row, column), or Azul.EMPTY
+        """
+        bit = row * 5 + column
+        if not self.occupied >> bit & 1:
+            return Azul.EMPTY
+        for color in Azul.COLORS:
+            if self.wall >> (color * 25 + bit) & 1:
+                return color
+
+    def can_receive_color(self, pileNumber, color):
+        """
+        Returns whether tiles of the given color can be added to pile 'pileNumber'
+        """
+        return self.receivable >> (color * 5 + pileNumber) & 1 != 0
 
     def piles_that_can_receive_color(self, color):
         """
@@ -83,31 +329,105 @@ class PlayerBoard():
             AND 
             whether an empty pile could be used (but that pile should not have )
         """
-        allowed_piles = []
-        for p in self.piles:
-            pile = self.piles[p]
-            # Has tiles already of DIFFERENT color -> skip pile
-            if pile["count"] > 0 and not pile["color"] == color:
-                # print(f"pilecount {pile['count']} > 0 and not pilecolor {pile['color']} == {color}")
-                continue
-            # Has tiles already of SAME color and NOT full yet
-            if pile["count"] > 0 and pile["color"] == color and pile["count"] < p+1:
-                # print(f"pilecount {pile['count']} > 0 and colors match and pilecount < {p+1}")
-                allowed_piles.append(p)
-
-            # Has no tiles yet AND wall still allows this tile
-            if pile["count"] == 0 and not color in self.wall[p]:
-                allowed_piles.append(p)
-        
-        return allowed_piles
+        return PILES_FOR_MASK[(self.receivable >> (color * 5)) & 0b11111].copy()
+
+    def foul_count(self):
+        return self.foul_tiles & 0b111
+
+    def foul_tile_count(self, kind):
+        """
+        Returns how many foul tiles of the given color (or the start player tile) are on the floor line
+        """
+        return (self.foul_tiles >> (3 + kind * 3)) & 0b111
+
+    def add_foul_tiles(self, kind, num):
+        """
+        Adds tiles to the floor line. Returns the number of tiles that didn't fit anymore.
+        """
+        fits = min(num, FLOOR_LINE_SIZE - (self.foul_tiles & 0b111))
+        self.foul_tiles += fits + (fits << (3 + kind * 3))
+        return num - fits
 
     def has_entire_horizontal_row(self):
-        return any( (not any(t == Azul.EMPTY for t in row)) for row in self.wall)
+        occupied = self.occupied
+        return any(occupied & mask == mask for mask in ROW_MASKS)
+
+    def complete_rows(self):
+        occupied = self.occupied
+        return sum(occupied & mask == mask for mask in ROW_MASKS)
+
+    def complete_columns(self):
+        occupied = self.occupied
+        return sum(occupied & mask == mask for mask in COLUMN_MASKS)
+
+    def complete_colors(self):
+        if self.difficulty == 0:
+            occupied = self.occupied
+            return sum(occupied & mask == mask for mask in COLOR_MASKS)
+        return sum(((self.wall >> (color * 25)) & FULL_WALL).bit_count() == 5 for color in Azul.COLORS)
+
+    def tile_score(self, row, column):
+        """
+        Returns the points for the tile that was just placed at (row, column):
+        the length of the horizontal and vertical lines of tiles it is part of.
+        """
+        occupied = self.occupied
+        row_bits = (occupied >> (row * 5)) & 0b11111
+        column_bits = ((((occupied >> column) & COLUMN_MASKS[0]) * COLUMN_GATHER) >> 20) & 0b11111
+        return (RUN_SCORE[row_bits][column] + RUN_SCORE[column_bits][row]) or 1
+
+    def floor_penalty(self):
+        return FLOOR_PENALTIES[self.foul_tiles & 0b111]
+
+    def end_game_bonus(self):
+        return (ROW_BONUS * self.complete_rows() + COLUMN_BONUS * self.complete_columns()
+                + COLOR_BONUS * self.complete_colors())
+
+    def key(self):
+        """
+        Returns the complete board contents as a hashable tuple of ints
+        """
+        return (self.wall, self.occupied, self.row_colors, self.receivable, self.piles, self.foul_tiles, self.score)
+
+    @classmethod
+    def from_key(cls, difficulty, key):
+        """
+        Builds a board from the tuple returned by 'key()'
+        """
+        board = PlayerBoard.__new__(PlayerBoard)
+        board.difficulty = difficulty
+        board.wall, board.occupied, board.row_colors, board.receivable, board.piles, board.foul_tiles, board.score = key
+        return board
+
+    def restore(self, key):
+        """
+        Sets the board back to a tuple returned by 'key()'
+        """
+        self.wall, self.occupied, self.row_colors, self.receivable, self.piles, self.foul_tiles, self.score = key
+
+    def copy(self):
+        board = PlayerBoard.__new__(PlayerBoard)
+        board.difficulty = self.difficulty
+        board.wall = self.wall
+        board.occupied = self.occupied
+        board.row_colors = self.row_colors
+        board.receivable = self.receivable
+        board.piles = self.piles
+        board.foul_tiles = self.foul_tiles
+        board.score = self.score
+        return board
+
+    def __eq__(self, other):
+        return isinstance(other, PlayerBoard) and self.difficulty == other.difficulty and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
 
     def __str__(self):
         result = ""
         for i in range(5):
-            result += "".join(self.wall[i]) + " " + "".join(self.piles[i]["color"] * self.piles[i]["count"]) + "\n"
+            color, count = self.pile(i)
+            result += "".join(Azul.SYMBOLS[self.wall_color(i, c)] for c in range(5)) + " " + Azul.SYMBOLS[color] * count + "\n"
         return result
 
     """
@@ -116,31 +436,46 @@ class PlayerBoard():
     Pile numbering is 0 - 4
     """
     def save_tiles_to_pile(self, pileNumber, tileColor, numberOfTiles):
-        pile = self.piles[pileNumber]
-        if pile["count"] + numberOfTiles > pileNumber + 1:
+        color, count = self.pile(pileNumber)
+        if count + numberOfTiles > pileNumber + 1:
             raise OverflowError(f"Pile {pileNumber} is at maximum capacity")
-        if pile["count"] > 0 and not pile["color"] == tileColor:
+        if count > 0 and not color == tileColor:
             raise ValueError("This color is not allowed on this pile anymore")
         # Check other tiles don't have the same color
-        if tileColor in [self.piles[p]["color"] for p in self.piles if not p == pileNumber]:
+        if tileColor in [self.pile(p)[0] for p in range(5) if not p == pileNumber]:
             raise ValueError("This color is already present in another pile")
         # Check that this pile doesn't correspond to a line in the wall that already has this color set
-        if tileColor in self.wall[pileNumber]:
+        if self.has_color_in_row(pileNumber, tileColor):
             raise OverflowError(f"This color is already present on the wall at line {pileNumber}")
 
-        pile["count"] += numberOfTiles
-        pile["color"] = tileColor
+        self.set_pile(pileNumber, tileColor, count + numberOfTiles)
 
-class Azul():
-    BLUE = "🟦"
-    YELLOW = "🟨"
-    RED = "🟥"
-    BLACK = "⬛"
-    WHITE = "⬜"
-    EMPTY = "▪️"
-    START_PLAYER_TILE = "1️⃣"
+    def set_pile(self, pileNumber, tileColor, numberOfTiles):
+        """
+        Overwrites a pile without any checks, an empty pile is stored as count 0
+        """
+        shift = pileNumber * PILE_BITS
+        value = (tileColor << 3 | numberOfTiles) if numberOfTiles else 0
+        self.piles = (self.piles & ~(PILE_MASK << shift)) | (value << shift)
+        self.update_receivable(pileNumber)
 
-    def __init__(self, num_players = 2, difficulty = 0):
+class Azul():
+    # Colors are numbered in the order they appear on the first line of the standard wall
+    BLUE = 0
+    YELLOW = 1
+    RED = 2
+    BLACK = 3
+    WHITE = 4
+    EMPTY = 5
+    START_PLAYER_TILE = 6
+    COLORS = (BLUE, YELLOW, RED, BLACK, WHITE)
+    # Factory index of the floor (the middle of the table)
+    FLOOR = -1
+    # Pile index to put tiles straight on the floor line of the board
+    FLOOR_LINE = 5
+    SYMBOLS = ("🟦", "🟨", "🟥", "⬛", "⬜", "▪️", "1️⃣")
+
+    def __init__(self, num_players = 2, difficulty = 0, seed = None):
         """
         Initialize game board.
         Each game board has
@@ -151,136 +486,998 @@ class Azul():
             - 'factories': piles of max 4 tiles that can be used to take tiles - can be any number of different colors
             - 'floor': tiles that fell on the floor (middle of the board) - can be any number of different colors
             - 'difficuly': 0 for standard tile board, 1 for no predefined colors allowed on the board
+            - 'first player': the player that starts the next round (whoever takes the start player tile)
+            - 'seed': seed of this game's own random generator, the same seed always deals the same tiles
+            - 'bag': the tile bag and box lid the factories are filled from
         """
         if num_players > 4 or num_players < 2:
             raise ValueError("Number of players must be 2, 3 or 4")
         if difficulty not in [0, 1]:
             raise ValueError("Difficulty must be either 0 or 1")
 
-        self.boards = [PlayerBoard(difficulty) for p in range(1, num_players)]
+        self.boards = [PlayerBoard(difficulty) for p in range(num_players)]
         self.num_players = num_players
         self.player = 0
+        self.first_player = 0
         self.winner = None
-        self.factories = [TileFactory() for p in range(1, num_players + 5)]
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.bag = TileBag(self.rng)
+        self.factories = [TileFactory(bag=self.bag) for p in range(2 * num_players + 1)]
         self.floor = TileFactory(True)
         self.difficulty = difficulty
+        self.zobrist = self.compute_zobrist()
 
     @classmethod
     def available_actions(cls, board, factories, floor):
         """
         available_actions(piles) returns all of the available actions '(i, j, k)' in that state (board, factories, floor).
 
-        Action '(i, j, k)' represents the action of removing all items of color 'j'
-        from factory 'i' (where factories are 0-indexed, -1 represents the floor) and adding
-        them to pile k of this player's board
+        Action '(i, j, k)' represents the action of removing all items of color 'i'
+        from factory 'j' (where factories are 0-indexed, -1 represents the floor) and adding
+        them to pile k of this player's board (5 puts them straight on the floor line)
 
         STATE = always the current board, all factories and the floor
         """
-        actions = set()
-        for factory in [f for f in factories if f.has_tiles()]:
-            colors = set(factory.tiles)
-            for color in colors:
-                for pile in board.piles_that_can_receive_color(color):
-                    actions.add((color, factory, pile))
+        return cls.actions_for_tiles(board, [factory.tiles for factory in factories], floor.tiles)
+
+    @classmethod
+    def state_actions(cls, state):
+        """
+        Returns all of the available actions in a state returned by 'state()'
+        """
+        player, difficulty, factories, floor, boards = state
+        board = PlayerBoard.from_key(difficulty, boards[player])
+        return cls.actions_for_tiles(board, factories, floor & ~START_PLAYER_BIT)
+
+    @classmethod
+    def actions_for_tiles(cls, board, factory_tiles, floor_tiles):
+        """
+        Returns all of the available actions for 'board', given the packed tiles of every factory and of the floor
+
+        The actions of a color in a factory only depend on the piles that can receive that color, so they
+        are looked up in ACTION_TABLE. No action tuples are created, the list only holds the shared ones.
+        """
+        actions = []
+        receivable = board.receivable
+        for j, tiles in enumerate(factory_tiles):
+            if not tiles:
+                continue
+            table = ACTION_TABLE[j + 1]
+            for color in Azul.COLORS:
+                if (tiles >> (color * COUNT_BITS)) & COUNT_MASK:
+                    actions += table[color][(receivable >> (color * 5)) & 0b11111]
         
-        floor_colors = set(floor.tiles)
-        for color in floor_colors:
-            if color == Azul.START_PLAYER_TILE:
-                continue # Can't pick up start tile alone
-            for pile in board.piles_that_can_receive_color(color):
-                actions.add((color, floor, pile))
+        # The start player tile is not a color, so it can't be picked up alone
+        if floor_tiles:
+            table = ACTION_TABLE[0]
+            for color in Azul.COLORS:
+                if (floor_tiles >> (color * COUNT_BITS)) & COUNT_MASK:
+                    actions += table[color][(receivable >> (color * 5)) & 0b11111]
 
         return actions
 
+    @classmethod
+    def pruned_actions(cls, board, factories, floor):
+        """
+        Returns the available actions like 'available_actions()' without actions that are never better than another one:
+            - factories with the same tiles give the same choices, only the first of them is used.
+              The center always keeps its actions, also when it has the same tiles as a factory
+            - on the standard wall, putting a color straight on the floor line is never better than putting it on a pile
+              that already holds that color: that pile ends the round at least as full with at most as many foul tiles.
+              This isn't used when the tile of the pile would complete its wall row, because that ends the game.
+        """
+        return cls.pruned_actions_for_tiles(board, [factory.tiles for factory in factories], floor.tiles)
+
+    @classmethod
+    def pruned_actions_for_tiles(cls, board, factory_tiles, floor_tiles):
+        # Colors that shouldn't go straight to the floor line
+        no_floor_line = 0
+        if board.difficulty == 0:
+            for pile in range(5):
+                color, count = board.pile(pile)
+                if 0 < count < pile + 1 and bin(board.occupied & ROW_MASKS[pile]).count("1") < 4:
+                    no_floor_line |= 1 << color
+
+        actions = []
+        receivable = board.receivable
+        seen = set()
+        for j, tiles in enumerate(factory_tiles + [floor_tiles]):
+            if not tiles:
+                continue
+            # The center is never the same as a factory: taking from it leaves the other tiles in the center
+            # and gives the start player tile
+            if j < len(factory_tiles):
+                if tiles in seen:
+                    continue
+                seen.add(tiles)
+            table = ACTION_TABLE[0 if j == len(factory_tiles) else j + 1]
+            for color in Azul.COLORS:
+                if (tiles >> (color * COUNT_BITS)) & COUNT_MASK:
+                    color_actions = table[color][(receivable >> (color * 5)) & 0b11111]
+                    # The floor line is always the last action of a color
+                    actions += color_actions[:-1] if no_floor_line >> color & 1 else color_actions
+        return actions
+
+    @classmethod
+    def reduction_ratio(cls, board, factories, floor):
+        """
+        Returns the part of the available actions that 'pruned_actions()' leaves out
+        """
+        total = len(cls.available_actions(board, factories, floor))
+        if not total:
+            return 0
+        return 1 - len(cls.pruned_actions(board, factories, floor)) / total
+
+    def state(self):
+        """
+        Returns the position as a hashable tuple of ints:
+        (player, difficulty, tiles of every factory, floor, key of every board)
+        """
+        return (self.player, self.difficulty, tuple(factory.tiles for factory in self.factories),
+                self.floor.key(), tuple(board.key() for board in self.boards))
+
+    @classmethod
+    def canonical_state(cls, state):
+        """
+        Returns '(key, colors, factories)' for a state returned by 'state()'.
+        'key' is a single int that is the same for all positions that only differ by symmetry:
+            - the boards are listed starting from the player to move, so the seats don't matter
+            - the factories are sorted by their tiles, so their order doesn't matter
+            - without predefined colors on the wall (difficulty 1) the colors are relabeled in order of where their tiles are
+        'colors' maps every color to its canonical color and 'factories' maps every factory to its canonical factory,
+        'canonical_action()' uses them to encode actions relative to the canonical state.
+        """
+        player, difficulty, factories, floor, boards = state
+        boards = boards[player:] + boards[:player]
+
+        colors = IDENTITY_COLORS
+        if difficulty == 1:
+            colors = cls.canonical_colors(factories, floor, boards)
+            if colors != IDENTITY_COLORS:
+                factories = tuple(relabel_tiles(tiles, colors) for tiles in factories)
+                floor = relabel_tiles(floor & ~START_PLAYER_BIT, colors) | (floor & START_PLAYER_BIT)
+                boards = tuple(relabel_board(board, colors) for board in boards)
+
+        sorted_factories = sorted(factories)
+        first = {}
+        for j, tiles in enumerate(sorted_factories):
+            first.setdefault(tiles, j)
+        factory_map = tuple(first[tiles] for tiles in factories)
+
+        # The number of players comes first, so keys with a different number of boards can't be equal
+        key = len(boards) << 1 | difficulty
+        for wall, occupied, row_colors, receivable, piles, foul_tiles, score in boards:
+            if difficulty == 0:
+                key = key << 25 | occupied
+            else:
+                key = key << 125 | wall
+            key = (((key << 30 | piles) << FOUL_TILES_BITS | foul_tiles) << 10) | score
+        for tiles in sorted_factories:
+            key = key << 25 | tiles
+        key = key << 26 | floor
+        return key, colors, factory_map
+
+    @classmethod
+    def canonical_colors(cls, factories, floor, boards):
+        """
+        Orders the colors by where their tiles are, which doesn't depend on how the colors are labeled.
+        Colors that can't be told apart keep their order.
+        """
+        def signature(color):
+            shift = color * COUNT_BITS
+            result = [sorted((tiles >> shift) & COUNT_MASK for tiles in factories), (floor >> shift) & COUNT_MASK]
+            for wall, occupied, row_colors, receivable, piles, foul_tiles, score in boards:
+                pile_counts = tuple((piles >> (p * PILE_BITS)) & 0b111 if (piles >> (p * PILE_BITS + 3)) & 0b111 == color else 0
+                                    for p in range(5))
+                result.append(((wall >> (color * 25)) & FULL_WALL, pile_counts, (foul_tiles >> (3 + color * 3)) & 0b111))
+            return result
+        order = sorted(Azul.COLORS, key=lambda color: (signature(color), color))
+        colors = [0] * len(Azul.COLORS)
+        for new, old in enumerate(order):
+            colors[old] = new
+        return tuple(colors)
+
+    @classmethod
+    def canonical_action(cls, action, colors, factories):
+        """
+        Returns the action code of 'action' in the canonical state, given 'colors' and 'factories' from 'canonical_state()'
+        """
+        color, factory, pile = action
+        if factory != Azul.FLOOR:
+            factory = factories[factory]
+        return cls.encode_action((colors[color], factory, pile))
+
+    @classmethod
+    def state_fingerprint(cls, state):
+        """
+        Returns a 64-bit fingerprint of a state (a tuple returned by 'state()' or a canonical key) that is the same
+        in every process and Python version
+        """
+        return int.from_bytes(hashlib.blake2b(repr(state).encode(), digest_size=8).digest(), "little")
+
+    @classmethod
+    def state_zobrist(cls, state):
+        """
+        Returns the 64-bit Zobrist key of a state returned by 'state()'.
+        Equal states have equal keys, different states have different keys except for rare collisions.
+        """
+        player, difficulty, factories, floor, boards = state
+        key = ZOBRIST_TO_MOVE[player] ^ ZOBRIST_NUM_PLAYERS[len(boards)] ^ ZOBRIST_DIFFICULTY[difficulty]
+        key ^= zobrist_word(ZOBRIST_FACTORIES[0], floor)
+        for i, tiles in enumerate(factories):
+            key ^= zobrist_word(ZOBRIST_FACTORIES[i + 1], tiles)
+        for p, (wall, occupied, row_colors, receivable, piles, foul_tiles, score) in enumerate(boards):
+            key ^= (zobrist_int(ZOBRIST_WALLS[p], wall) ^ zobrist_word(ZOBRIST_PILES[p], piles)
+                    ^ zobrist_word(ZOBRIST_FOULS[p], foul_tiles) ^ zobrist_int(ZOBRIST_SCORES[p], score & 0xFFFF))
+        return key
+
+    def compute_zobrist(self):
+        """
+        Computes the Zobrist key of the current position from scratch.
+        'self.zobrist' is kept up to date by 'move()' and 'unmake_move()', after changing a position
+        by hand it has to be set to this again.
+        """
+        return Azul.state_zobrist(self.state())
+
+    def move_zobrist(self, player, factory_index):
+        """
+        Returns the XOR of the Zobrist keys of the parts a move of 'player' from 'factory_index' changes
+        during the round: the factory, the floor and the piles and floor line of the player
+        """
+        board = self.boards[player]
+        floor = self.floor
+        key = zobrist_word(ZOBRIST_FACTORIES[0], floor.tiles | START_PLAYER_BIT if floor.start_player else floor.tiles)
+        if factory_index != Azul.FLOOR:
+            key ^= zobrist_word(ZOBRIST_FACTORIES[factory_index + 1], self.factories[factory_index].tiles)
+        return key ^ zobrist_word(ZOBRIST_PILES[player], board.piles) ^ zobrist_word(ZOBRIST_FOULS[player], board.foul_tiles)
+
+    @classmethod
+    def encode_action(cls, action):
+        """
+        Returns an action '(i, j, k)' as a single int below 'ACTION_CODES'
+        """
+        color, factory, pile = action
+        return ((factory + 1) * 5 + color) * 6 + pile
+
+    @classmethod
+    def decode_action(cls, code):
+        factory, rest = divmod(code, 30)
+        color, pile = divmod(rest, 6)
+        return (color, factory - 1, pile)
+
+    def make_move(self, action, trusted = False):
+        """
+        Make the move 'action' like 'move()' and return an undo record that 'unmake_move()' uses to restore
+        the exact position before the move.
+
+        The record is a flat tuple with the player, the first player, the factory and its tiles, the floor,
+        the board of the player, the lid and the Zobrist key. Only a move that ends the round also records all boards,
+        factories, the bag, the random generator and the winner, because the end of a round changes all of them.
+        """
+        color, factory_index, pile = action
+        factory = self.floor if factory_index == Azul.FLOOR else self.factories[factory_index]
+        board = self.boards[self.player]
+
+        round_record = None
+        if self.ends_round(color, factory):
+            round_record = (tuple(board.key() for board in self.boards), tuple(factory.tiles for factory in self.factories),
+                            self.bag.bag, self.bag.bag_size, self.rng.getstate(), self.winner)
+        undo = (self.player, self.first_player, factory_index, factory.tiles, self.floor.key(), board.key(),
+                self.bag.lid, self.bag.lid_size, self.zobrist, round_record)
+
+        self.move(action, trusted)
+        return undo
+
+    def unmake_move(self, undo):
+        """
+        Take back the move that returned the undo record 'undo'. Moves must be taken back in reverse order.
+        """
+        player, first_player, factory_index, factory_tiles, floor, board, lid, lid_size, zobrist, round_record = undo
+
+        if round_record is not None:
+            boards, factories, self.bag.bag, self.bag.bag_size, rng_state, self.winner = round_record
+            for b, key in zip(self.boards, boards):
+                b.restore(key)
+            for f, tiles in zip(self.factories, factories):
+                f.tiles = tiles
+            self.rng.setstate(rng_state)
+
+        self.player = player
+        self.first_player = first_player
+        self.boards[player].restore(board)
+        self.floor.restore(floor)
+        if factory_index != Azul.FLOOR:
+            self.factories[factory_index].tiles = factory_tiles
+        self.bag.lid = lid
+        self.bag.lid_size = lid_size
+        self.zobrist = zobrist
+
+    def ends_round(self, color, factory):
+        """
+        Returns whether taking 'color' from 'factory' takes the last tiles of the round
+        """
+        if factory.tiles != factory.count(color) << (color * COUNT_BITS):
+            return False
+        if factory is not self.floor and self.floor.tiles:
+            return False
+        return not any(f.tiles for f in self.factories if f is not factory)
+
     def next_player(self):
         """
         Switch the current player to the next player.
         """
         self.player = (self.player + 1) % self.num_players
 
-    def move(self, action):
+    def is_valid_action(self, action):
+        """
+        Returns whether 'action' is one of the available actions of the current player,
+        without generating all available actions.
+        """
+        color, factory_index, pile = action
+        if color not in Azul.COLORS or not Azul.FLOOR <= factory_index < len(self.factories):
+            return False
+        factory = self.floor if factory_index == Azul.FLOOR else self.factories[factory_index]
+        if not factory.count(color):
+            return False
+        if pile == Azul.FLOOR_LINE:
+            return True
+        return 0 <= pile < 5 and self.boards[self.player].can_receive_color(pile, color)
+
+    def tiles_left(self):
+        """
+        Returns how many tiles are left on the factories and the floor this round
+        """
+        return self.floor.tile_count() + sum(factory.tile_count() for factory in self.factories)
+
+    def immediate_gain(self, action):
+        """
+        Returns how many points the current player gains or loses this round with 'action':
+        the points of the tile that goes on the wall if the pile gets full, minus the extra floor penalty.
+        """
+        color, factory_index, pile = action
+        factory = self.floor if factory_index == Azul.FLOOR else self.factories[factory_index]
+        board = self.boards[self.player]
+        count = factory.count(color)
+        gain = 0
+        fouls = count
+        if pile != Azul.FLOOR_LINE:
+            pile_count = board.pile(pile)[1]
+            fits = min(count, pile + 1 - pile_count)
+            fouls = count - fits
+            column = board.column_for_color(pile, color) if pile_count + fits == pile + 1 else -1
+            # Without a column for the color the full pile goes to the lid without points, like in 'score_round()'
+            if column >= 0:
+                occupied = board.occupied
+                board.occupied |= 1 << (pile * 5 + column)
+                gain = board.tile_score(pile, column)
+                board.occupied = occupied
+        if factory is self.floor and self.floor.start_player:
+            fouls += 1
+        foul_count = board.foul_count()
+        return gain + FLOOR_PENALTIES[min(foul_count + fouls, FLOOR_LINE_SIZE)] - FLOOR_PENALTIES[foul_count]
+
+    def move(self, action, trusted = False):
         """
         Make the move 'action' for the current player.
         'action' must be a tuple '(i, j, k)' where i is the color to remove from factory j (-1 for the floor)
         to pile k
+
+        With 'trusted' the action isn't validated. Only use it for actions that come from 'available_actions()'.
         """
-        color, factory, pile = action
+        color, factory_index, pile = action
 
         # Check for errors
-        if self.winner is not None:
-            raise Exception("Game already won")
-        if len(factory.tiles) <= 0:
-            raise Exception("Selected factory has no tiles left")
-        if pile < 0 or pile >= len(self.piles):
-            raise Exception("Invalid pile")
-        if not action in self.available_actions(board, self.factories, self.floor):
-            raise Exception("Invalid action")
-
+        if not trusted:
+            if self.winner is not None:
+                raise Exception("Game already won")
+            if not Azul.FLOOR <= factory_index < len(self.factories):
+                raise Exception("Invalid factory")
+            if pile < 0 or pile > Azul.FLOOR_LINE:
+                raise Exception("Invalid pile")
+            if not self.is_valid_action(action):
+                raise Exception("Invalid action")
+
+        factory = self.floor if factory_index == Azul.FLOOR else self.factories[factory_index]
         board = self.boards[self.player]
+        player = self.player
+        zobrist = self.zobrist ^ ZOBRIST_TO_MOVE[player] ^ self.move_zobrist(player, factory_index)
 
         # Update board
-        # 1. Set the color (in case it wasn't set yet)
-        board.piles[pile]["color"] = color
-        # 2. Take tiles from the factory
-        count = factory.take_tiles(color)
-        # 3. Add them to the board
-        board.piles[pile]["count"] += count
+        # 1. Take tiles from the factory, the rest of the factory goes to the floor
+        count = factory.take_tiles(color, self.floor)
+        # 2. Add them to the board (this also sets the color in case it wasn't set yet)
+        fits = 0
+        if pile != Azul.FLOOR_LINE:
+            pile_count = board.pile(pile)[1]
+            fits = min(count, pile + 1 - pile_count)
+            board.set_pile(pile, color, pile_count + fits)
+        # 3. Tiles that don't fit on the pile anymore are foul tiles, once the floor line is full they go to the lid
+        if count > fits:
+            self.bag.discard(color, board.add_foul_tiles(color, count - fits))
         # 4. If taken from the floor
-        if factory == self.floor and Azul.START_PLAYER_TILE in self.floor.tiles:
+        if factory is self.floor and self.floor.start_player:
             # Add the START PLAYER tile to the board and remove it from the floor
-            self.floor.remove(Azul.START_PLAYER_TILE)
-            board.foul_tiles.append(Azul.START_PLAYER_TILE)
+            self.floor.start_player = False
+            self.first_player = self.player
+            board.add_foul_tiles(Azul.START_PLAYER_TILE, 1)
         
-        self.next_player()
-        if self.player == 0:
-            self.score_round()
+        if self.is_end_round():
+            self.end_round()
+            self.zobrist = self.compute_zobrist()
+        else:
+            self.next_player()
+            self.zobrist = zobrist ^ ZOBRIST_TO_MOVE[self.player] ^ self.move_zobrist(player, factory_index)
+
+    def is_end_round(self):
+        return not self.floor.tiles and not any(factory.tiles for factory in self.factories)
+
+    def end_round(self):
+        """
+        Scores the round, then either ends the game or refills the factories for the next round
+        """
+        self.score_round()
 
         # Check for a winner
         if self.is_end_game():
-            self.score_end_game()
-        
-        self.winner = max(self.boards, key = lambda b: b.score)
+            self.end_game()
+            return
+
+        for factory in self.factories:
+            factory.produce_tiles(self.bag)
+        self.floor.produce_tiles()
+        self.player = self.first_player
+
+        # Only happens when all tiles are stuck on the boards
+        if self.is_end_round():
+            self.end_game()
+
+    def end_game(self):
+        self.score_end_game()
+        # Ties are won by the player with the most complete horizontal rows
+        self.winner = max(range(self.num_players), key = lambda p: (self.boards[p].score, self.boards[p].complete_rows()))
 
     def is_end_game(self):
-        return any(board.has_entire_horizontal_row for board in self.boards)
+        return any(board.has_entire_horizontal_row() for board in self.boards)
 
     def score_round(self):
         for board in self.boards:
             # Go pile by pile
             added_score = 0
-            for p in board.piles:
-                pile = board.piles[p]
-                pile_count = pile["count"]
-                pile_color = pile["color"]
+            for p in range(5):
+                pile_color, pile_count = board.pile(p)
                 # If the pile is full, shift to the wall
                 if pile_count == p + 1:
-                    # Shift to the wall
-                    idx = board.allowed_colors[p].index(pile_color)
-                    board.wall[p][idx] = pile_color
+                    # Shift to the wall, the rest of the pile goes to the lid
+                    if board.column_for_color(p, pile_color) >= 0:
+                        column = board.place_on_wall(p, pile_color)
+                        self.bag.discard(pile_color, p)
+                        # Now score
+                        added_score += board.tile_score(p, column)
+                    else:
+                        self.bag.discard(pile_color, p + 1)
                     # Empty the pile
-                    pile["count"] = 0
-                    pile["color"] = Azul.EMPTY
+                    board.set_pile(p, pile_color, 0)
 
-                    # Now score
-                    # TODO
+            # Foul tiles cost points and go to the lid, the score can't go below 0
+            added_score += board.floor_penalty()
+            board.score = max(0, board.score + added_score)
+            for color in Azul.COLORS:
+                self.bag.discard(color, board.foul_tile_count(color))
+            board.foul_tiles = 0
 
     def score_end_game(self):
+        for board in self.boards:
+            board.score += board.end_game_bonus()
+
+# ACTION_TABLE[factory + 1][color][piles] lists the actions that take 'color' from 'factory' (the floor is factory -1)
+# when 'piles' is the 5-bit mask of piles that can receive the color. The floor line is always allowed.
+MAX_FACTORIES = 9
+ACTION_TABLE = [[[tuple((color, factory, pile) for pile in PILES_FOR_MASK[piles] + [Azul.FLOOR_LINE])
+                  for piles in range(32)]
+                 for color in Azul.COLORS]
+                for factory in range(Azul.FLOOR, MAX_FACTORIES)]
+
+ACTION_CODES = (MAX_FACTORIES + 1) * 30
+IDENTITY_COLORS = tuple(Azul.COLORS)
+# Foul tiles take a field for the total and one for every tile kind up to the start player tile
+FOUL_FIELD_BITS = FLOOR_LINE_SIZE.bit_length()
+FOUL_TILES_BITS = FOUL_FIELD_BITS * (Azul.START_PLAYER_TILE + 2)
+
+# Zobrist keys: the packed ints of a position are hashed a byte at a time with a table of random 64-bit keys per
+# part of the position and byte position. Byte value 0 has key 0, so the key of a position is the XOR of the keys
+# of its non-empty parts and a move only XORs out the old and in the new keys of the parts it changes.
+_zobrist_rng = random.Random(0x2A1)
+
+def zobrist_table(num_bytes):
+    return [[0] + [_zobrist_rng.getrandbits(64) for value in range(255)] for i in range(num_bytes)]
+
+ZOBRIST_TO_MOVE = [_zobrist_rng.getrandbits(64) for p in range(4)]
+ZOBRIST_NUM_PLAYERS = [_zobrist_rng.getrandbits(64) for p in range(5)]
+ZOBRIST_DIFFICULTY = [0, _zobrist_rng.getrandbits(64)]
+# Indexed by factory index + 1, the floor is 0. Factory keys have 26 bits with the start player bit.
+ZOBRIST_FACTORIES = [zobrist_table(4) for factory in range(MAX_FACTORIES + 1)]
+ZOBRIST_WALLS = [zobrist_table(16) for p in range(4)]
+ZOBRIST_PILES = [zobrist_table(4) for p in range(4)]
+ZOBRIST_FOULS = [zobrist_table(4) for p in range(4)]
+ZOBRIST_SCORES = [zobrist_table(2) for p in range(4)]
+
+def zobrist_int(table, value):
+    """
+    Returns the Zobrist key of a non-negative packed int with the byte table 'table'
+    """
+    key = 0
+    for keys in table:
+        if not value:
+            break
+        key ^= keys[value & 0xFF]
+        value >>= 8
+    return key
+
+def zobrist_word(table, value):
+    """
+    'zobrist_int()' for values of at most 32 bits, unrolled because every move needs a few of them
+    """
+    return table[0][value & 0xFF] ^ table[1][value >> 8 & 0xFF] ^ table[2][value >> 16 & 0xFF] ^ table[3][value >> 24]
+
+def relabel_tiles(tiles, colors):
+    """
+    Returns packed tile counts with color c moved to color 'colors[c]'
+    """
+    result = 0
+    for color in Azul.COLORS:
+        result |= ((tiles >> (color * COUNT_BITS)) & COUNT_MASK) << (colors[color] * COUNT_BITS)
+    return result
+
+def relabel_board(key, colors):
+    """
+    Returns a board key with color c moved to color 'colors[c]', only the wall, piles, foul tiles and score are kept
+    """
+    wall, occupied, row_colors, receivable, piles, foul_tiles, score = key
+    new_wall = 0
+    new_piles = 0
+    new_foul_tiles = foul_tiles & 0b111 | foul_tiles & (0b111 << (3 + Azul.START_PLAYER_TILE * 3))
+    for color in Azul.COLORS:
+        new_wall |= ((wall >> (color * 25)) & FULL_WALL) << (colors[color] * 25)
+        new_foul_tiles |= ((foul_tiles >> (3 + color * 3)) & 0b111) << (3 + colors[color] * 3)
+    for p in range(5):
+        pile = (piles >> (p * PILE_BITS)) & PILE_MASK
+        if pile & 0b111:
+            pile = colors[pile >> 3] << 3 | pile & 0b111
+        new_piles |= pile << (p * PILE_BITS)
+    return (new_wall, occupied, 0, 0, new_piles, new_foul_tiles, score)
+
+class StateValues():
+    __slots__ = ("codes", "values", "best")
+
+    def __init__(self, codes):
+        """
+        Q-values of all available actions of one state
+            - 'codes': the sorted canonical action codes
+            - 'values': the Q-value of every action code, 0 until it is updated
+            - 'best': the index of the highest Q-value, kept up to date on every update
+        """
+        self.codes = array.array("H", sorted(codes))
+        self.values = array.array("d", bytes(8 * len(self.codes)))
+        self.best = 0
+
+    def index(self, code):
+        i = bisect.bisect_left(self.codes, code)
+        if i < len(self.codes) and self.codes[i] == code:
+            return i
+        return -1
+
+    def get(self, code):
+        i = self.index(code)
+        if i < 0:
+            raise KeyError(code)
+        return self.values[i]
+
+    def set(self, code, value):
+        """
+        Sets the Q-value of an action code and returns whether the action code is new
+        """
+        i = self.index(code)
+        new = i < 0
+        if new:
+            i = bisect.bisect_left(self.codes, code)
+            self.codes.insert(i, code)
+            self.values.insert(i, value)
+            if i <= self.best and len(self.codes) > 1:
+                self.best += 1
+        best_value = self.values[self.best]
+        self.values[i] = value
+        if i == self.best:
+            if value < best_value:
+                self.best = max(range(len(self.values)), key=self.values.__getitem__)
+        elif value >= best_value:
+            self.best = i
+        return new
+
+    def best_value(self):
+        return self.values[self.best] if self.values else 0
+
+    def best_code(self):
+        return self.codes[self.best]
+
+class QStore():
+
+    def __init__(self):
+        """
+        Q-table that maps every canonical state to the 'StateValues' of its available actions.
+        It can also be used like a dictionary that maps '(state, action code)' to a Q-value.
+        """
+        self.states = dict()
+        self.count = 0
+
+    def lookup(self, key):
+        """
+        Returns the 'StateValues' of a canonical state, or None if the state has no Q-values
+        """
+        return self.states.get(key)
+
+    def add(self, key, codes):
+        values = StateValues(codes)
+        self.states[key] = values
+        self.count += len(values.codes)
+        return values
+
+    def __getitem__(self, key):
+        state, code = key
+        return self.states[state].get(code)
+
+    def __setitem__(self, key, value):
+        state, code = key
+        values = self.states.get(state)
+        if values is None:
+            values = self.add(state, [code])
+        self.count += values.set(code, value)
+
+    def __contains__(self, key):
+        state, code = key
+        values = self.states.get(state)
+        return values is not None and values.index(code) >= 0
+
+    def items(self):
+        for state, values in self.states.items():
+            for code, value in zip(values.codes, values.values):
+                yield (state, code), value
+
+    def __len__(self):
+        return self.count
+
+class TrackedStateValues(StateValues):
+    __slots__ = ("visits", "change", "size", "slot")
+
+class BoundedQStore(QStore):
+    EVICTION_POLICIES = ("lru", "visits", "change")
+    # Number of random states to compare when evicting by visits or Q-value change
+    SAMPLE_SIZE = 5
+    # Estimated bytes for the dictionary slot of a state
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, memory_budget, eviction="lru", seed=0):
+        """
+        QStore that stays within 'memory_budget' bytes by evicting states when a new state is added.
+        'eviction' decides which state goes:
+            - 'lru': the state that was used longest ago
+            - 'visits': the state with the fewest visits
+            - 'change': the state whose last update changed its Q-value the least
+        LRU keeps the states in use order, so evicting is O(1). The other policies pick the worst of
+        'SAMPLE_SIZE' random states, so evicting stays O(1) as well.
+        """
+        super().__init__()
+        if eviction not in BoundedQStore.EVICTION_POLICIES:
+            raise ValueError(f"Eviction must be one of {', '.join(BoundedQStore.EVICTION_POLICIES)}")
+        self.memory_budget = memory_budget
+        self.eviction = eviction
+        self.states = collections.OrderedDict()
+        self.keys = []
+        self.rng = random.Random(seed)
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        values = self.states.get(key)
+        if values is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        values.visits += 1
+        if self.eviction == "lru":
+            self.states.move_to_end(key)
+        return values
+
+    def add(self, key, codes):
+        values = TrackedStateValues(codes)
+        values.visits = 1
+        values.change = 0
+        values.size = (BoundedQStore.ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(values)
+                       + sys.getsizeof(values.codes) + sys.getsizeof(values.values))
+        while self.states and self.bytes + values.size > self.memory_budget:
+            self.evict()
+
+        values.slot = len(self.keys)
+        self.keys.append(key)
+        self.states[key] = values
+        self.count += len(values.codes)
+        self.bytes += values.size
+        return values
+
+    def __setitem__(self, key, value):
+        state, code = key
+        values = self.states.get(state)
+        if values is None:
+            values = self.add(state, [code])
+        i = values.index(code)
+        old = values.values[i] if i >= 0 else 0
+        self.count += values.set(code, value)
+        values.change = abs(value - old)
+
+    def evict(self):
+        if self.eviction == "lru":
+            key = next(iter(self.states))
+        else:
+            metric = "visits" if self.eviction == "visits" else "change"
+            candidates = [self.keys[self.rng.randrange(len(self.keys))] for i in range(BoundedQStore.SAMPLE_SIZE)]
+            key = min(candidates, key=lambda key: getattr(self.states[key], metric))
+        values = self.states.pop(key)
+
+        # Move the last key into the slot of the evicted one
+        last = self.keys.pop()
+        if values.slot < len(self.keys):
+            self.keys[values.slot] = last
+            self.states[last].slot = values.slot
+
+        self.count -= len(values.codes)
+        self.bytes -= values.size
+        self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.states),
+            "values": self.count,
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+class QTableFile():
+    MAGIC = b"AZULQ001"
+    HEADER = struct.Struct("<8sQ")
+
+    def __init__(self, path):
+        """
+        Q-table that is memory-mapped from a file written by 'save()'.
+        The file is only read, the states that are used are copied to the 'updates' QStore and updated there.
+        Processes that load the same file share its pages through the page cache.
+
+        The file has a header (magic and number of entries) and three arrays in native byte order:
+            - 'keys': the 64-bit fingerprint of the state of every entry, sorted
+            - 'actions': the 16-bit action code of every entry, sorted within a state
+            - 'values': the Q-value of every entry as a 32-bit float
+        All entries of a state are next to each other and are found with one binary search.
+        """
+        self.updates = QStore()
+        # Entries of the file that were copied to 'updates', so 'len()' counts them once
+        self.copied = 0
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = QTableFile.HEADER.unpack_from(self.mmap)
+        if magic != QTableFile.MAGIC:
+            raise ValueError(f"{path} is not a Q-table file")
+        view = memoryview(self.mmap)
+        keys_start = QTableFile.HEADER.size
+        actions_start = keys_start + 8 * self.count
+        values_start = actions_start + QTableFile.padded(2 * self.count)
+        self.keys = view[keys_start:actions_start].cast("Q")
+        self.actions = view[actions_start:actions_start + 2 * self.count].cast("H")
+        self.values = view[values_start:values_start + 4 * self.count].cast("f")
+
+    @staticmethod
+    def padded(size):
+        return (size + 7) // 8 * 8
+
+    @staticmethod
+    def save(path, entries):
+        """
+        Writes entries '((state fingerprint, action code), value)' to a Q-table file
+        """
+        entries = sorted(entries)
+        keys = array.array("Q", (key for (key, action), value in entries))
+        actions = array.array("H", (action for (key, action), value in entries))
+        values = array.array("f", (value for (key, action), value in entries))
+        with open(path, "wb") as f:
+            f.write(QTableFile.HEADER.pack(QTableFile.MAGIC, len(entries)))
+            keys.tofile(f)
+            actions.tofile(f)
+            f.write(bytes(QTableFile.padded(2 * len(entries)) - 2 * len(entries)))
+            values.tofile(f)
+
+    def state_range(self, fingerprint):
+        """
+        Returns the first and last + 1 index of the entries of a state
+        """
+        start = bisect.bisect_left(self.keys, fingerprint)
+        end = start
+        while end < self.count and self.keys[end] == fingerprint:
+            end += 1
+        return start, end
+
+    def lookup(self, key):
+        """
+        Returns the 'StateValues' of a canonical state like 'QStore.lookup()', reading them from the file the first time
+        """
+        values = self.updates.lookup(key)
+        if values is None:
+            start, end = self.state_range(Azul.state_fingerprint(key))
+            if start == end:
+                return None
+            values = self.updates.add(key, self.actions[start:end])
+            self.copied += end - start
+            for i in range(start, end):
+                values.set(self.actions[i], self.values[i])
+        return values
+
+    def add(self, key, codes):
+        return self.updates.add(key, codes)
+
+    def __getitem__(self, key):
+        state, code = key
+        values = self.lookup(state)
+        if values is None:
+            raise KeyError(key)
+        return values.get(code)
+
+    def __setitem__(self, key, value):
+        state, code = key
+        self.lookup(state)
+        self.updates[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def entries(self):
+        """
+        Returns all entries as '((state fingerprint, action code), value)', updated values replace those of the file
+        """
+        result = {(self.keys[i], self.actions[i]): self.values[i] for i in range(self.count)}
+        for (state, code), value in self.updates.items():
+            result[Azul.state_fingerprint(state), code] = value
+        return result.items()
+
+    def __len__(self):
+        return self.count + len(self.updates) - self.copied
+
+    def close(self):
+        self.keys.release()
+        self.actions.release()
+        self.values.release()
+        self.mmap.close()
+
+class TranspositionTable():
+
+    def __init__(self, size=1 << 16):
+        """
+        Fixed-size table from Zobrist keys of positions to values, so a search that reaches a position
+        through another move order can reuse what it found before.
+        'size' is rounded up to a power of 2, a key can only be stored in slot 'key & (size - 1)'.
+
+        Every entry has a 'depth': how deep the search below the position went. A new entry only replaces
+        an entry of another position with the same or a lower depth, because deeper entries save more work.
+        A table should hold one kind of value, like the nodes of a search tree or canonical states.
+        """
+        size = 1 << (max(size, 2) - 1).bit_length()
+        self.mask = size - 1
+        self.keys = array.array("Q", bytes(8 * size))
+        self.depths = array.array("h", [-1]) * size
+        self.values = [None] * size
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def probe(self, key):
+        """
+        Returns '(depth, value)' of the entry of 'key', or None if it isn't in the table
+        """
+        self.probes += 1
+        i = key & self.mask
+        if self.keys[i] == key and self.depths[i] >= 0:
+            self.hits += 1
+            return self.depths[i], self.values[i]
+        return None
+
+    def store(self, key, depth, value):
+        """
+        Stores 'value' for 'key' unless its slot holds an entry with a higher depth. Returns whether it was stored.
+        """
+        i = key & self.mask
+        old_depth = self.depths[i]
+        if old_depth > depth:
+            return False
+        if old_depth >= 0 and self.keys[i] != key:
+            self.replacements += 1
+        self.keys[i] = key
+        self.depths[i] = depth
+        self.values[i] = value
+        self.stores += 1
+        return True
+
+    def clear(self):
+        self.depths = array.array("h", [-1]) * len(self.depths)
+        self.values = [None] * len(self.values)
+
+    def stats(self):
+        return {
+            "size": len(self.depths),
+            "entries": len(self.depths) - self.depths.count(-1),
+            "probes": self.probes,
+            "hits": self.hits,
+            "stores": self.stores,
+            "replacements": self.replacements,
+            "hit_ratio": self.hits / self.probes if self.probes else 0,
+        }
 
 class NimAI():
 
-    def __init__(self, alpha=0.5, epsilon=0.1):
+    def __init__(self, alpha=0.5, epsilon=0.1, seed=None, memory_budget=None, eviction="lru", table=None):
         """
         Initialize AI with an empty Q-learning dictionary,
         an alpha (learning) rate, and an epsilon rate.
 
-        The Q-learning dictionary maps '(state, action)'
-        pairs to a Q-value (a number).
-         - 'state' is a tuple of remaining piles, e.g. (1, 1, 4, 4)
-         - 'action' is a tuple '(i, j)' for an action
+        The Q-learning table is a 'QStore' that maps every state
+        to the Q-values of its available actions.
+         - 'state' is the canonical key of a tuple returned by 'Azul.state()'
+         - 'action' is the canonical code of an action '(i, j, k)'
+        With a 'memory_budget' in bytes, the table is a 'BoundedQStore'
+        that evicts states with the 'eviction' policy.
+        With a 'TranspositionTable' as 'table', 'choose_move()' remembers the canonical
+        states of positions by their Zobrist key.
         """
-        self.q = dict()
+        if memory_budget is None:
+            self.q = QStore()
+        else:
+            self.q = BoundedQStore(memory_budget, eviction)
         self.alpha = alpha
         self.epsilon = epsilon
+        self.rng = random.Random(seed)
+        self.last_canonical = (None, None)
+        self.table = table
+        # Optional 'TrainingMonitor' that times move generation and counts Q-table hits
+        self.monitor = None
+
+    def save(self, path):
+        """
+        Save the Q-table to a compact binary file that 'load()' memory-maps
+        """
+        if isinstance(self.q, QTableFile):
+            entries = self.q.entries()
+        else:
+            # One fingerprint per state, the states in fingerprint order give the entries almost sorted
+            states = sorted(((Azul.state_fingerprint(state), values) for state, values in self.q.states.items()),
+                            key=lambda item: item[0])
+            entries = (((fingerprint, code), value) for fingerprint, values in states
+                       for code, value in zip(values.codes, values.values))
+        QTableFile.save(path, entries)
+
+    @classmethod
+    def load(cls, path, alpha=0.5, epsilon=0.1, seed=None):
+        """
+        Create an AI with the Q-table of a file written by 'save()'
+        """
+        player = cls(alpha, epsilon, seed)
+        player.q = QTableFile(path)
+        return player
 
     def update(self, old_state, action, new_state, reward):
         """
@@ -288,17 +1485,81 @@ class NimAI():
         in that state, a new resulting state, and the reward received
         from taking that action.
         """
-        old = self.get_q_value(old_state, action)
+        key, colors, factories = self.canonical(old_state)
+        code = Azul.canonical_action(action, colors, factories)
+        values = self.lookup(key)
+        i = values.index(code) if values is not None else -1
+        old = values.values[i] if i >= 0 else 0
         best_future = self.best_future_reward(new_state)
-        self.update_q_value(old_state, action, old, reward, best_future)
+        if values is None:
+            self.q.add(key, {Azul.canonical_action(a, colors, factories) for a in self.state_actions(old_state)})
+        self.q[key, code] = old + self.alpha * ((reward + best_future) - old)
+
+    def canonical(self, state):
+        """
+        Return 'Azul.canonical_state(state)', the last result is remembered because
+        'update()' needs the same state a few times in a row.
+        """
+        last_state, result = self.last_canonical
+        if state is not last_state:
+            result = Azul.canonical_state(state)
+            self.last_canonical = (state, result)
+        return result
+
+    def state_values(self, state, create=False):
+        """
+        Return the 'StateValues' of 'state' and the color and factory mapping to its canonical form.
+        With 'create' a state without Q-values gets a Q-value of 0 for all of its available actions.
+        """
+        key, colors, factories = self.canonical(state)
+        values = self.lookup(key)
+        if values is None and create:
+            codes = {Azul.canonical_action(action, colors, factories) for action in self.state_actions(state)}
+            values = self.q.add(key, codes)
+        return values, colors, factories
+
+    def lookup(self, key):
+        values = self.q.lookup(key)
+        if self.monitor is not None:
+            self.monitor.lookup(values is not None)
+        return values
+
+    def prepare_transition(self, old_state, action, new_state, reward):
+        """
+        Returns a transition as '(key, action code, action codes, new key, reward)': the canonical keys of both states,
+        the canonical code of the action and of all available actions of the old state.
+        'update_prepared()' only has to look up and write Q-values for it, so this part can be done in another process.
+        """
+        key, colors, factories = self.canonical(old_state)
+        codes = tuple(sorted({Azul.canonical_action(a, colors, factories) for a in self.state_actions(old_state)}))
+        code = Azul.canonical_action(action, colors, factories)
+        return key, code, codes, self.canonical(new_state)[0], reward
+
+    def update_prepared(self, key, code, codes, new_key, reward):
+        """
+        Update the Q-learning model like 'update()' with a transition returned by 'prepare_transition()'.
+        The Q-table is looked up in the same order as 'update()' does, so a 'BoundedQStore' evicts the same states.
+        """
+        values = self.lookup(key)
+        i = values.index(code) if values is not None else -1
+        old = values.values[i] if i >= 0 else 0
+        new_values = self.lookup(new_key)
+        best_future = new_values.best_value() if new_values is not None else 0
+        # Looking up doesn't evict, so 'values' is still the entry of 'key'
+        if values is None:
+            self.q.add(key, codes)
+        self.q[key, code] = old + self.alpha * ((reward + best_future) - old)
 
     def get_q_value(self, state, action):
         """
         Return the Q-value for the state 'state' and the action 'action'.
         If no Q-value exists yet in 'self.q', return 0.
         """
+        values, colors, factories = self.state_values(state)
+        if values is None:
+            return 0
         try:
-            return self.q[tuple(state), action]
+            return values.get(Azul.canonical_action(action, colors, factories))
         except KeyError:
             return 0
 
@@ -318,7 +1579,16 @@ class NimAI():
         is the sum of the current reward and estimated future rewards.
         """
         new_value = old_q + self.alpha * ( (reward + future_rewards) - old_q)
-        self.q[tuple(state), action] = new_value
+        self.state_values(state, create=True)
+        self.q[self.q_key(state, action)] = new_value
+
+    def q_key(self, state, action):
+        """
+        Return the key of 'state' and 'action' in 'self.q': the canonical state and the canonical action code,
+        so that positions that only differ by symmetry share their Q-values.
+        """
+        key, colors, factories = self.canonical(state)
+        return key, Azul.canonical_action(action, colors, factories)
 
     def best_future_reward(self, state):
         """
@@ -329,27 +1599,17 @@ class NimAI():
         Use 0 as the Q-value if a '(state, action)' pair has no
         Q-value in 'self.q'. If there are no available actions in
         'state', return 0.
+
+        The maximum is kept up to date by the Q-table, so this is a single lookup.
         """
-        max = -sys.maxsize
-        available_actions = Nim.available_actions(state)
-        if len(available_actions) == 0:
+        values, colors, factories = self.state_values(state)
+        if values is None:
             return 0
-
-        for action in available_actions:
-            q_value = 0
-            try:
-                q_value = self.q[tuple(state), action]
-            except KeyError:
-                pass
-
-            if q_value > max:
-                max = q_value
-
-        return max
+        return values.best_value()
 
     def choose_action(self, state, epsilon=True):
         """
-        Given a state 'state', return an action '(i, j)' to take.
+        Given a state 'state', return an action '(i, j, k)' to take.
 
         If 'epsilon' is 'False', then return the best action
         available in the state (the one with the highest Q-value,
@@ -367,95 +1627,273 @@ class NimAI():
             epsilon_to_use = 0
         
         # If epsilon = 0.4, any value UNDER 0.4 is according to epsilon
-        if random.random() >= epsilon_to_use:
+        if self.rng.random() >= epsilon_to_use:
             return self.get_best_action(state)
         else:
             return self.get_random_action(state)
 
     def get_best_action(self, state):
-        max = -sys.maxsize
-        current_best = None
-        for action in Nim.available_actions(state):
-            q_value = 0
-            try:
-                q_value = self.q[tuple(state), action]
-            except KeyError:
-                pass
-
-            if q_value > max:
-                max = q_value
-                current_best = action
-        
-        return current_best
+        values, colors, factories = self.state_values(state)
+        if values is None:
+            # Every action has a Q-value of 0
+            actions = self.state_actions(state)
+            return actions[0] if actions else None
+
+        # Turn the best canonical action back into an action of this state
+        color, factory, pile = Azul.decode_action(values.best_code())
+        if factory != Azul.FLOOR:
+            factory = factories.index(factory)
+        return (colors.index(color), factory, pile)
 
     def get_random_action(self, state):
-        return random.choice(list(Nim.available_actions(state)))
+        return self.rng.choice(list(self.state_actions(state)))
+
+    def state_actions(self, state):
+        if self.monitor is None:
+            return Azul.state_actions(state)
+        token = self.monitor.begin()
+        actions = Azul.state_actions(state)
+        self.monitor.end("movegen", token)
+        return actions
 
-def train(n):
+    def choose_move(self, game):
+        """
+        Return the best action in the position of 'game'
+        """
+        state = game.state()
+        if self.table is not None:
+            entry = self.table.probe(game.zobrist)
+            if entry is None:
+                canonical = Azul.canonical_state(state)
+                self.table.store(game.zobrist, 0, canonical)
+            else:
+                canonical = entry[1]
+            self.last_canonical = (state, canonical)
+        return self.choose_action(state, epsilon=False)
+
+def game_transitions(game, choose, monitor=None):
     """
-    Train an AI by playing 'n' games against itself.
+    Plays 'game' until it is over with the actions 'choose(state)' returns and yields the transitions
+    '(state, action, new_state, reward)' of the game in the order they should be used to update the Q-values.
+    Every transition is yielded before the next action is chosen, so the AI can learn from it first.
+    A 'TrainingMonitor' as 'monitor' times choosing the actions and making the moves.
     """
+    # Keep track of last move made by any player
+    last = {
+        p: {"state": None, "action": None} for p in range(game.num_players)
+    }
 
-    player = NimAI()
-
-    # Play n games
-    for i in range(n):
-        print(f"Playing training game {i + 1}")
-        game = Nim()
-
-        # Keep track of last move made by either player
-        last = {
-            0: {"state": None, "action": None},
-            1: {"state": None, "action": None}
-        }
-
-        # Game loop
-        while True:
-
-            # Keep track of current state and action
-            state = game.piles.copy()
-            action = player.choose_action(game.piles)
-
-            # Keep track of last state and action
-            last[game.player]["state"] = state
-            last[game.player]["action"] = action
-
-            # Make move
-            game.move(action)
-            new_state = game.piles.copy()
-
-            # When game is over, update Q values with rewards
-            if game.winner is not None:
-                player.update(state, action, new_state, -1)
-                player.update(
-                    last[game.player]["state"],
-                    last[game.player]["action"],
-                    new_state,
-                    1
-                )
-                break
+    # Game loop
+    while True:
 
-            # If game is continuing, no rewards yet
-            elif last[game.player]["state"] is not None:
-                player.update(
-                    last[game.player]["state"],
-                    last[game.player]["action"],
-                    new_state,
-                    0
-                )
+        # Keep track of current state and action
+        if monitor is not None:
+            token = monitor.begin()
+        state = game.state()
+        action = choose(state)
+        if monitor is not None:
+            monitor.end("select", token)
+
+        # Keep track of last state and action
+        last[game.player]["state"] = state
+        last[game.player]["action"] = action
+
+        # Make move, the action comes from the available actions so it doesn't need to be checked
+        if monitor is not None:
+            token = monitor.begin()
+        game.move(action, trusted=True)
+        new_state = game.state()
+        if monitor is not None:
+            monitor.end("step", token)
+
+        # When game is over, update Q values with rewards
+        if game.winner is not None:
+            for p in range(game.num_players):
+                if last[p]["state"] is not None:
+                    yield (
+                        last[p]["state"],
+                        last[p]["action"],
+                        new_state,
+                        1 if p == game.winner else -1
+                    )
+            return
+
+        # If game is continuing, no rewards yet
+        elif last[game.player]["state"] is not None:
+            yield (
+                last[game.player]["state"],
+                last[game.player]["action"],
+                new_state,
+                0
+            )
+
+def self_play(player, game, learn=True, monitor=None, actions=None):
+    """
+    Let 'player' make every move of 'game' until the game is over.
+    Returns the transitions '(state, action, new_state, reward)' of the game in the
+    order they should be used to update the Q-values.
+    If 'learn' is True, the player is also updated right after every move.
+    A 'TrainingMonitor' as 'monitor' times the moves and updates and counts the game.
+    The actions played are appended to the list 'actions' if it is given, to record the game.
+    """
+    if actions is None:
+        actions = []
+    played = len(actions)
+
+    def choose(state):
+        action = player.choose_action(state)
+        actions.append(action)
+        return action
+
+    transitions = []
+    for state, action, new_state, reward in game_transitions(game, choose, monitor):
+        transitions.append((state, action, new_state, reward))
+        if learn:
+            if monitor is None:
+                player.update(state, action, new_state, reward)
+            else:
+                token = monitor.begin()
+                player.update(state, action, new_state, reward)
+                monitor.end("update", token)
+                monitor.updates += 1
+
+    if monitor is not None:
+        monitor.game_done(len(actions) - played, len(player.q) if isinstance(player, NimAI) else 0)
+    return transitions
+
+def train(n, seed=0, num_players=2, workers=1, batch_size=50, sync_interval=1000, memory_budget=None, eviction="lru",
+          player=None, monitor=None, log=None):
+    """
+    Train an AI by playing 'n' games against itself.
+    Game 'i' is played with seed 'seed + i', so a training run can be reproduced.
+    With a 'memory_budget' in bytes, the Q-table evicts states with the 'eviction' policy to stay within it.
+    Another AI with the same 'choose_action()' and 'update()' methods, like 'LinearAI', can be trained by passing it as 'player'.
+    Progress is reported through the 'TrainingMonitor' 'monitor', for instance as JSON lines in a file.
+    Every game is written to the 'GameLogWriter' 'log' if it is given, to train on it again later with 'train_offline()'.
+
+    With more than 1 worker, the games are played by a pool of 'workers' processes:
+        - every worker plays batches of 'batch_size' games with a snapshot of the AI and sends back the transitions,
+          a 'NimAI' sends them with the canonical keys and action codes already worked out ('prepare_transition()')
+        - the transitions are used to update the AI in the order of the games, so the result doesn't depend on timing
+        - every 'sync_interval' games the workers load a new snapshot of the AI from a file. The snapshot of a 'NimAI'
+          is a Q-table file, which the workers memory-map and share through the page cache.
+    """
 
-    print("Done training")
-    print(sorted(player.q.items()))
+    if player is None:
+        player = NimAI(seed=seed, memory_budget=memory_budget, eviction=eviction)
+
+    if monitor is not None:
+        monitor.start()
+    if isinstance(player, NimAI):
+        player.monitor = monitor
+    if workers > 1:
+        train_parallel(player, n, seed, num_players, workers, batch_size, sync_interval, monitor, log)
+    else:
+        # Play n games
+        for i in range(n):
+            actions = []
+            self_play(player, Azul(num_players, seed=seed + i), monitor=monitor, actions=actions)
+            if log is not None:
+                log.write(seed + i, num_players, actions)
+    if isinstance(player, NimAI):
+        player.monitor = None
+    if monitor is not None:
+        monitor.stop()
+
+    if isinstance(player, NimAI):
+        print(f"Done training, {len(player.q)} Q-values")
+    else:
+        print("Done training")
 
     # Return the trained AI
     return player
 
-
-def play(ai, human_player=None):
+def train_parallel(player, n, seed, num_players, workers, batch_size, sync_interval, monitor, log=None):
+    prepared = isinstance(player, NimAI)
+    update = player.update_prepared if prepared else player.update
+    with tempfile.TemporaryDirectory() as directory, \
+            multiprocessing.Pool(workers, initializer=_init_training_worker, initargs=(num_players,)) as pool:
+        snapshot = None
+        for start in range(0, n, sync_interval):
+            seeds = range(seed + start, seed + min(n, start + sync_interval))
+            batches = [seeds[i:i + batch_size] for i in range(0, len(seeds), batch_size)]
+
+            # The workers switch to a snapshot of the AI as it is now when they get their next batch
+            if snapshot is not None:
+                os.remove(snapshot[0])
+            snapshot = save_snapshot(player, os.path.join(directory, f"snapshot{start}"))
+
+            for results in pool.imap(_play_training_games, [(snapshot, batch) for batch in batches]):
+                for game_seed, transitions, actions in results:
+                    if log is not None:
+                        log.write(game_seed, num_players, actions)
+                    if monitor is None:
+                        for transition in transitions:
+                            update(*transition)
+                        continue
+                    # The moves are made by the workers, only the updates are timed here
+                    token = monitor.begin()
+                    for transition in transitions:
+                        update(*transition)
+                    monitor.end("update", token)
+                    monitor.updates += len(transitions)
+                    monitor.game_done(len(actions), len(player.q) if prepared else 0)
+
+def save_snapshot(player, path):
+    """
+    Saves a snapshot of an AI for the training workers and returns how to load it: '(path, alpha, epsilon)'
+    for the Q-table file of a 'NimAI', '(path, None, None)' for any other AI, which is pickled
+    """
+    if isinstance(player, NimAI):
+        player.save(path)
+        return path, player.alpha, player.epsilon
+    with open(path, "wb") as f:
+        pickle.dump(player, f)
+    return path, None, None
+
+def load_snapshot(snapshot):
+    path, alpha, epsilon = snapshot
+    if alpha is not None:
+        return NimAI.load(path, alpha, epsilon)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+_worker_player = None
+_worker_snapshot = None
+_worker_num_players = None
+
+def _init_training_worker(num_players):
+    global _worker_num_players
+    _worker_num_players = num_players
+
+def _play_training_games(task):
+    global _worker_player, _worker_snapshot
+    snapshot, seeds = task
+    if snapshot != _worker_snapshot:
+        if isinstance(_worker_player, NimAI):
+            _worker_player.q.close()
+        _worker_player = load_snapshot(snapshot)
+        _worker_snapshot = snapshot
+
+    results = []
+    for game_seed in seeds:
+        # The random choices of the AI only depend on the game, not on the worker playing it
+        _worker_player.rng.seed(game_seed)
+        game = Azul(_worker_num_players, seed=game_seed)
+        actions = []
+        transitions = self_play(_worker_player, game, learn=False, actions=actions)
+        if isinstance(_worker_player, NimAI):
+            transitions = [_worker_player.prepare_transition(*transition) for transition in transitions]
+        results.append((game_seed, transitions, actions))
+    return results
+
+
+def play(ai, human_player=None, seed=None, delay=1):
     """
     Play human game against the AI.
     'human_player' can be set to 0 or 1 to specify whether
     human player moves first or second.
+    Every turn waits 'delay' seconds, so the moves of the AI can be followed.
     """
 
     # If no player order set, choose human's order randomly
@@ -463,40 +1901,46 @@ def play(ai, human_player=None):
         human_player = random.randint(0, 1)
 
     # Create new game
-    game = Nim()
+    game = Azul(seed=seed)
 
     # Game loop
     while True:
 
-        # Print contents of piles
+        # Print boards, factories and floor
         print()
-        print("Piles:")
-        for i, pile in enumerate(game.piles):
-            print(f"Pile {i}: {pile}")
+        for p, board in enumerate(game.boards):
+            print(f"Player {p} ({board.score} points):")
+            print(board)
+        print("Factories:")
+        for i, factory in enumerate(game.factories):
+            print(f"Factory {i}: {factory}")
+        print(f"Floor ({Azul.FLOOR}): {game.floor}")
         print()
 
         # Compute available actions
-        available_actions = Nim.available_actions(game.piles)
-        time.sleep(1)
+        available_actions = Azul.available_actions(game.boards[game.player], game.factories, game.floor)
+        time.sleep(delay)
 
         # Let human make a move
         if game.player == human_player:
             print("Your Turn")
+            print("Colors: " + ", ".join(f"{color} = {Azul.SYMBOLS[color]}" for color in Azul.COLORS))
             while True:
+                color = int(input("Choose Color: "))
+                factory = int(input("Choose Factory: "))
                 pile = int(input("Choose Pile: "))
-                count = int(input("Choose Count: "))
-                if (pile, count) in available_actions:
+                if (color, factory, pile) in available_actions:
                     break
                 print("Invalid move, try again.")
 
         # Have AI make a move
         else:
             print("AI's Turn")
-            pile, count = ai.choose_action(game.piles, epsilon=False)
-            print(f"AI chose to take {count} from pile {pile}.")
+            color, factory, pile = ai.choose_move(game)
+            print(f"AI chose to take {Azul.SYMBOLS[color]} from factory {factory} to pile {pile}.")
 
         # Make move
-        game.move((pile, count))
+        game.move((color, factory, pile))
 
         # Check for winner
         if game.winner is not None:
@@ -504,4 +1948,4 @@ def play(ai, human_player=None):
             print("GAME OVER")
             winner = "Human" if game.winner == human_player else "AI"
             print(f"Winner is {winner}")
-            return
\ No newline at end of file
+            return
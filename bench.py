@@ -0,0 +1,227 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from azul import Azul, NimAI, self_play
+
+# Benchmarks where a lower value is better, all others are throughputs
+LOWER_IS_BETTER = {"q_bytes_per_entry", "q_file_bytes_per_entry"}
+# Every timed run repeats its workload for at least this many seconds
+MIN_REPEAT_TIME = 0.2
+
+def random_games(num_games, seed=0, num_players=2):
+    """
+    Plays 'num_games' random games with fixed seeds and returns the actions of every game
+    """
+    games = []
+    for i in range(num_games):
+        game = Azul(num_players, seed=seed + i)
+        rng = random.Random(seed + i)
+        actions = []
+        while game.winner is None:
+            action = rng.choice(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+            actions.append(action)
+            game.move(action, trusted=True)
+        games.append((seed + i, actions))
+    return games
+
+def positions(games, num_players=2):
+    """
+    Returns a copy of the game before every 5th move of the recorded games
+    """
+    result = []
+    for game_seed, actions in games:
+        game = Azul(num_players, seed=game_seed)
+        for i, action in enumerate(actions):
+            if i % 5 == 0:
+                result.append(copy.deepcopy(game))
+            game.move(action, trusted=True)
+    return result
+
+def run_time(function, min_time=MIN_REPEAT_TIME):
+    """
+    Returns the time of one call of 'function' in seconds.
+    'function' is called until 'min_time' seconds have passed, so short workloads aren't measured by timer noise.
+    """
+    gc.collect()
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+def best_rates(workloads, repeat):
+    """
+    Returns '{name: items per second}' for workloads '{name: (function, items per call)}', from the fastest of 'repeat' runs.
+    The runs of every workload are spread over the whole benchmark, one run of every workload per round,
+    so a slow moment of the machine doesn't decide the result of one workload.
+    """
+    best = {}
+    for i in range(repeat):
+        for name, (function, items) in workloads.items():
+            elapsed = run_time(function)
+            best[name] = elapsed if name not in best else min(best[name], elapsed)
+    return {name: workloads[name][1] / best[name] for name in workloads}
+
+def bench_available_actions(games):
+    games_positions = positions(games)
+    arguments = [(game.boards[game.player], game.factories, game.floor) for game in games_positions]
+
+    def run():
+        for board, factories, floor in arguments:
+            Azul.available_actions(board, factories, floor)
+    return run, len(arguments)
+
+def bench_moves(games):
+    def run():
+        for game_seed, actions in games:
+            game = Azul(seed=game_seed)
+            for action in actions:
+                game.move(action, trusted=True)
+    return run, sum(len(actions) for game_seed, actions in games)
+
+def bench_score_round(games):
+    # Boards late in a round, when most piles have tiles, are restored before every 'score_round()'
+    games_positions = [game for game in positions(games) if game.tiles_left() <= 8]
+    saved = [(game, [board.key() for board in game.boards], game.bag.lid, game.bag.lid_size) for game in games_positions]
+
+    def run():
+        for game, boards, lid, lid_size in saved:
+            for board, key in zip(game.boards, boards):
+                board.restore(key)
+            game.bag.lid = lid
+            game.bag.lid_size = lid_size
+            game.score_round()
+    return run, sum(len(game.boards) for game in games_positions)
+
+def bench_games(num_games):
+    return (lambda: random_games(num_games, seed=1000)), num_games
+
+def recorded_transitions(num_games):
+    player = NimAI(seed=0)
+    transitions = []
+    for i in range(num_games):
+        transitions += self_play(player, Azul(seed=i), learn=False)
+    return transitions
+
+def bench_nimai(num_games):
+    """
+    Returns the update and best action workloads of a 'NimAI' and its bytes per Q-value in memory and in a file
+    """
+    transitions = recorded_transitions(num_games)
+
+    def update():
+        player = NimAI(seed=0)
+        for transition in transitions:
+            player.update(*transition)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    player = NimAI(seed=0)
+    for transition in transitions:
+        player.update(*transition)
+    gc.collect()
+    q_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    states = [state for state, action, new_state, reward in transitions]
+
+    def choose():
+        for state in states:
+            player.choose_action(state, epsilon=False)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.qtable")
+        player.save(path)
+        file_bytes = os.path.getsize(path)
+
+    return (update, len(transitions)), (choose, len(states)), q_bytes / len(player.q), file_bytes / len(player.q)
+
+def run_benchmarks(quick=False, repeat=None):
+    """
+    Runs every benchmark and returns '{name: value}'. The timed benchmarks take the fastest of 'repeat' rounds.
+    """
+    num_games = 10 if quick else 50
+    if repeat is None:
+        repeat = 2 if quick else 5
+    games = random_games(num_games)
+    updates, choices, q_bytes, file_bytes = bench_nimai(num_games)
+    results = best_rates({
+        "available_actions_per_sec": bench_available_actions(games),
+        "moves_per_sec": bench_moves(games),
+        "score_round_boards_per_sec": bench_score_round(games),
+        "random_games_per_sec": bench_games(num_games),
+        "nimai_updates_per_sec": updates,
+        "nimai_choose_action_per_sec": choices,
+    }, repeat)
+    results["q_bytes_per_entry"] = q_bytes
+    results["q_file_bytes_per_entry"] = file_bytes
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the benchmarks that are more than 'tolerance' (a fraction) worse than the baseline,
+    as '(name, value, baseline value, change)' where change is the fraction the value is worse
+    """
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if name in LOWER_IS_BETTER:
+            change = (value - base) / base
+        else:
+            change = (base - value) / base
+        if change > tolerance:
+            regressions.append((name, value, base, change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Azul engine benchmarks")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file with baseline results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction a benchmark can be worse than the baseline before it is a regression")
+    parser.add_argument("--quick", action="store_true", help="fewer games and repeats")
+    parser.add_argument("--repeat", type=int, help="rounds of the timed benchmarks, more rounds are steadier on a busy machine")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.quick, args.repeat)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "quick": args.quick,
+        "results": results,
+    }
+    for name, value in results.items():
+        print(f"{name:32} {value:14.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for name, value, base, change in regressions:
+            print(f"REGRESSION {name}: {value:.1f} vs {base:.1f} ({change:.0%} worse)")
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
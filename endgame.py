@@ -0,0 +1,150 @@
+import math
+import time
+
+from azul import Azul, TranspositionTable
+
+# Kinds of values in the transposition table of the solver
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+# Depth stored for values that didn't hit the depth limit anywhere, they are valid for any depth
+SOLVED_DEPTH = 1000
+
+class EndgameSolver():
+
+    def __init__(self, max_nodes=50000, time_limit=None, table_size=1 << 16):
+        """
+        Alpha-beta search to the end of the current round, which is the last point the game is known:
+        after it the factories are refilled at random.
+
+        The value of a position is the score of the player to move at the root minus the best score of the other players,
+        after the round is scored. Every other player is assumed to play against the root player.
+
+        The search deepens one move at a time (iterative deepening), every iteration tries the best move of the last one first
+        and then the moves with the highest 'Azul.immediate_gain()'. Positions are remembered by Zobrist key in a transposition table.
+        A position at the depth limit is valued with the current scores plus the floor penalties so far.
+        Only the moves of 'Azul.pruned_actions()' are searched, the others are never better within the round.
+
+        The search stops after 'max_nodes' positions or 'time_limit' seconds, whichever comes first.
+        """
+        self.max_nodes = max_nodes
+        self.time_limit = time_limit
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+
+    def solve(self, game):
+        """
+        Returns '(action, value, exact)': the best move and its value of the deepest iteration that finished,
+        'exact' is True when the search reached the end of the round everywhere.
+        When not even the first iteration finished, the action and value are None.
+        """
+        self.root_player = game.player
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+        self.table.clear()
+
+        result = (None, None, False)
+        depth = 1
+        while True:
+            self.cut = False
+            value = self.search(game, depth, -math.inf, math.inf, root=True)
+            if self.stopped:
+                return result
+            result = (self.root_move, value, not self.cut)
+            if not self.cut:
+                return result
+            depth += 1
+
+    def search(self, game, depth, alpha, beta, root=False):
+        """
+        Returns the value of the position of 'game' searched 'depth' moves deep within the window 'alpha' to 'beta'.
+        At the 'root' the best move is kept in 'self.root_move'.
+        """
+        self.nodes += 1
+        if self.nodes >= self.max_nodes or (self.deadline is not None and self.nodes % 1024 == 0
+                                             and time.perf_counter() >= self.deadline):
+            self.stopped = True
+            return 0
+
+        entry = self.table.probe(game.zobrist)
+        best_move = None
+        if entry is not None:
+            entry_depth, (value, kind, best_move) = entry
+            if entry_depth >= depth and not root:
+                if kind == LOWER_BOUND:
+                    alpha = max(alpha, value)
+                elif kind == UPPER_BOUND:
+                    beta = min(beta, value)
+                if kind == EXACT or alpha >= beta:
+                    self.cut = self.cut or entry_depth < SOLVED_DEPTH
+                    return value
+
+        if depth == 0:
+            self.cut = True
+            return self.evaluate(game)
+
+        actions = Azul.pruned_actions(game.boards[game.player], game.factories, game.floor)
+        actions.sort(key=lambda action: (action == best_move, game.immediate_gain(action)), reverse=True)
+
+        # Every other player plays against the root player
+        maximizing = game.player == self.root_player
+        best_value = -math.inf if maximizing else math.inf
+        low, high = alpha, beta
+        cut = self.cut
+        self.cut = False
+        for action in actions:
+            undo = game.make_move(action, trusted=True)
+            if undo[-1] is not None:
+                # The round is over, so the value is known
+                value = self.evaluate(game)
+            else:
+                value = self.search(game, depth - 1, alpha, beta)
+            game.unmake_move(undo)
+            if self.stopped:
+                return 0
+
+            if maximizing and value > best_value or not maximizing and value < best_value:
+                best_value = value
+                best_move = action
+            if maximizing:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                break
+
+        if root:
+            self.root_move = best_move
+        if best_value <= low:
+            kind = UPPER_BOUND
+        elif best_value >= high:
+            kind = LOWER_BOUND
+        else:
+            kind = EXACT
+        self.table.store(game.zobrist, depth if self.cut else SOLVED_DEPTH, (best_value, kind, best_move))
+        self.cut = cut or self.cut
+        return best_value
+
+    def evaluate(self, game):
+        scores = [board.score + board.floor_penalty() for board in game.boards]
+        return scores[self.root_player] - max(score for p, score in enumerate(scores) if p != self.root_player)
+
+class EndgamePlayer():
+
+    def __init__(self, player, max_tiles=8, solver=None):
+        """
+        AI that plays like 'player', but solves the rest of the round with an 'EndgameSolver' once
+        at most 'max_tiles' tiles are left on the factories and the floor.
+        When the solver doesn't finish within its budget, 'player' chooses the move.
+        """
+        self.player = player
+        self.max_tiles = max_tiles
+        self.solver = solver if solver is not None else EndgameSolver()
+
+    def choose_move(self, game):
+        if game.tiles_left() <= self.max_tiles:
+            action, value, exact = self.solver.solve(game)
+            if exact:
+                return action
+        return self.player.choose_move(game)
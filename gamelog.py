@@ -0,0 +1,213 @@
+import argparse
+import mmap
+import os
+
+from azul import Azul, NimAI, game_transitions
+
+# Every log file starts with this, the number is the version of the format
+MAGIC = b"AZULLOG1"
+
+def write_varint(value, out):
+    """
+    Appends the non-negative int 'value' to the bytearray 'out', 7 bits per byte with the high bit set on all bytes but the last
+    """
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, offset):
+    """
+    Returns the varint at 'offset' of 'data' and the offset after it.
+    Raises 'IndexError' when 'data' ends inside the varint.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+class GameLogWriter():
+
+    def __init__(self, path):
+        """
+        Appends game records to the file 'path', creating it when it doesn't exist.
+
+        A game is recorded as the seed it was dealt with and the actions that were played,
+        the positions are replayed from that. Every record is:
+            - the length of the rest of the record
+            - the seed, the number of players and the difficulty
+            - the action codes of 'Azul.encode_action()' until the end of the record
+        all as varints, so most actions take 1 byte and a game of 2 players about 70 bytes.
+        The length comes first, so a reader can skip a record without decoding it and stops cleanly at
+        a record that was cut off by a crash.
+        """
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.games = 0
+
+    def write(self, seed, num_players, actions, difficulty=0):
+        """
+        Appends a game that was dealt with 'seed' and played with 'actions'
+        """
+        if seed is None or seed < 0:
+            raise ValueError("Only games with a non-negative seed can be replayed")
+        body = bytearray()
+        write_varint(seed, body)
+        write_varint(num_players, body)
+        write_varint(difficulty, body)
+        for action in actions:
+            write_varint(Azul.encode_action(action), body)
+        record = bytearray()
+        write_varint(len(body), record)
+        self.file.write(record + body)
+        self.games += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class GameRecord():
+    __slots__ = ("seed", "num_players", "difficulty", "codes")
+
+    def __init__(self, seed, num_players, difficulty, codes):
+        """
+        A recorded game, 'codes' are the varint action codes. Nothing is decoded or replayed until it is asked for.
+        """
+        self.seed = seed
+        self.num_players = num_players
+        self.difficulty = difficulty
+        self.codes = codes
+
+    def actions(self):
+        """
+        Yields the actions of the game
+        """
+        offset = 0
+        while offset < len(self.codes):
+            code, offset = read_varint(self.codes, offset)
+            yield Azul.decode_action(code)
+
+    def game(self):
+        """
+        Returns the game as it was dealt, before the first move
+        """
+        return Azul(self.num_players, self.difficulty, self.seed)
+
+    def positions(self):
+        """
+        Yields the game before every move and once more after the last move.
+        The same game object is yielded every time, moved on by one action.
+        """
+        game = self.game()
+        for action in self.actions():
+            yield game
+            check_action(game, action)
+            game.move(action, trusted=True)
+        yield game
+
+    def transitions(self, monitor=None):
+        """
+        Yields the transitions '(state, action, new_state, reward)' of the game,
+        the same as 'self_play()' returns when it plays the game
+        """
+        game = self.game()
+        actions = self.actions()
+
+        def choose(state):
+            action = next(actions, None)
+            if action is None:
+                raise ValueError("Game record ends before the game is over")
+            check_action(game, action)
+            return action
+
+        return game_transitions(game, choose, monitor)
+
+def check_action(game, action):
+    # A record only replays while dealing and playing a game works the same as when it was recorded
+    if not game.is_valid_action(action):
+        raise ValueError(f"Game record doesn't replay: {action} isn't a valid move")
+
+def read_games(path):
+    """
+    Yields the 'GameRecord' of every game in the log file 'path', in the order they were written.
+    The file is memory mapped, so only the records that are being read are in memory.
+    A last record that is incomplete, because writing it was cut off, is left out.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a game log")
+        offset = len(MAGIC)
+        while offset < len(data):
+            try:
+                length, start = read_varint(data, offset)
+            except IndexError:
+                return
+            end = start + length
+            if end > len(data):
+                return
+            seed, position = read_varint(data, start)
+            num_players, position = read_varint(data, position)
+            difficulty, position = read_varint(data, position)
+            yield GameRecord(seed, num_players, difficulty, data[position:end])
+            offset = end
+
+def train_offline(paths, player=None, epochs=1, monitor=None):
+    """
+    Trains an AI on the games of the log files 'paths', 'epochs' times over, without choosing any moves.
+    The transitions of every game are replayed from its record and passed to 'player.update()' in the order
+    'self_play()' does, so training on the log of a 'train()' run gives the same Q-values as the run itself.
+    'player' is a new 'NimAI' by default, any AI with the same 'update()' method, like 'LinearAI', can be passed.
+    A 'TrainingMonitor' as 'monitor' times the replayed moves and updates and counts the games.
+    """
+    if player is None:
+        player = NimAI()
+    if monitor is not None:
+        monitor.start()
+    for epoch in range(epochs):
+        for path in paths:
+            for record in read_games(path):
+                for transition in record.transitions(monitor):
+                    if monitor is None:
+                        player.update(*transition)
+                        continue
+                    token = monitor.begin()
+                    player.update(*transition)
+                    monitor.end("update", token)
+                    monitor.updates += 1
+                if monitor is not None:
+                    monitor.game_done(sum(1 for action in record.actions()), len(player.q) if isinstance(player, NimAI) else 0)
+    if monitor is not None:
+        monitor.stop()
+    return player
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Trains an AI on recorded games of Azul")
+    parser.add_argument("logs", nargs="+", help="game log files")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--qtable", default="azul.qtable", help="file the Q-table of the trained AI is saved to")
+    args = parser.parse_args(argv)
+
+    games = sum(1 for path in args.logs for record in read_games(path))
+    print(f"Training on {games} games")
+    player = train_offline(args.logs, epochs=args.epochs)
+    print(f"Done training, {len(player.q)} Q-values")
+    player.save(args.qtable)
+
+if __name__ == "__main__":
+    main()
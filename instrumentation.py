@@ -0,0 +1,157 @@
+import collections
+import json
+import sys
+import threading
+import time
+
+class TrainingMonitor():
+    PHASES = ("movegen", "select", "update", "step")
+
+    def __init__(self, path=None, callback=None, interval=10.0, profiler=None):
+        """
+        Collects where the time of a training run goes and how the Q-table grows.
+
+        Time is kept per phase: generating moves, selecting actions, updating the AI and stepping the game.
+        A phase that runs inside another phase only counts for itself, so the phases add up to the total.
+
+        Every 'interval' seconds at most, 'emit()' writes a snapshot of the counters as one JSON line
+        to the file 'path' and/or passes it as a dict to 'callback'.
+        'profiler' is an optional object with 'start()', 'stop()' and 'top()' methods, like 'SamplingProfiler';
+        it runs while the monitor is started and its 'top()' is added to every snapshot.
+        """
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.profiler = profiler
+        self.file = None
+        self.times = dict.fromkeys(TrainingMonitor.PHASES, 0.0)
+        # Time of all phases that ended so far, to leave nested phases out of the phase around them
+        self.nested = 0.0
+        self.games = 0
+        self.moves = 0
+        self.updates = 0
+        self.hits = 0
+        self.misses = 0
+        self.q_entries = 0
+        self.last_q_entries = 0
+        self.start_time = None
+        self.last_emit = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.last_emit = self.start_time
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def stop(self):
+        """
+        Emits a last snapshot and closes the file
+        """
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.emit(force=True)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def begin(self):
+        """
+        Starts timing a phase, the result has to be passed to 'end()'
+        """
+        return time.perf_counter(), self.nested
+
+    def end(self, phase, token):
+        start, nested = token
+        elapsed = time.perf_counter() - start
+        self.times[phase] += elapsed - (self.nested - nested)
+        self.nested = nested + elapsed
+
+    def lookup(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def game_done(self, moves, q_entries):
+        self.games += 1
+        self.moves += moves
+        self.q_entries = q_entries
+        self.emit()
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start_time
+        lookups = self.hits + self.misses
+        snapshot = {
+            "seconds": elapsed,
+            "games": self.games,
+            "moves": self.moves,
+            "updates": self.updates,
+            "games_per_sec": self.games / elapsed if elapsed else 0,
+            "average_game_length": self.moves / self.games if self.games else 0,
+            "phase_seconds": dict(self.times),
+            "q_entries": self.q_entries,
+            "new_q_entries": self.q_entries - self.last_q_entries,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+        if self.profiler is not None:
+            snapshot["profile"] = self.profiler.top()
+        return snapshot
+
+    def emit(self, force=False):
+        """
+        Writes a snapshot if 'interval' seconds have passed since the last one, or always with 'force'
+        """
+        now = time.perf_counter()
+        if not force and now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+        snapshot = self.snapshot()
+        self.last_q_entries = self.q_entries
+        if self.path is not None:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(json.dumps(snapshot) + "\n")
+            self.file.flush()
+        if self.callback is not None:
+            self.callback(snapshot)
+
+class SamplingProfiler():
+
+    def __init__(self, interval=0.005, size=10):
+        """
+        Profiler that looks at the function the profiled thread is running every 'interval' seconds.
+        It costs almost nothing in the profiled thread, unlike a profiler that traces every call.
+        'top()' returns the 'size' functions where most samples were taken.
+        """
+        self.interval = interval
+        self.size = size
+        self.samples = collections.Counter()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                code = frame.f_code
+                self.samples[f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}"] += 1
+            time.sleep(self.interval)
+
+    def top(self):
+        """
+        Returns '[location, fraction of the samples]' of the functions with the most samples
+        """
+        total = sum(self.samples.values())
+        return [[location, count / total] for location, count in self.samples.most_common(self.size)]
@@ -0,0 +1,280 @@
+import math
+import multiprocessing
+import random
+import time
+
+from azul import Azul, TranspositionTable
+
+try:
+    from simulator import BatchedAzul
+except ImportError:
+    BatchedAzul = None
+
+class SearchTree():
+
+    def __init__(self):
+        """
+        Node statistics of a search tree, kept in flat lists indexed by node number instead of node objects.
+        Node 0 is the root, the children of a node are numbered 'first_child' up to 'first_child + child_count':
+            - 'parent': the node that was expanded into the node, -1 for the root
+            - 'action': the action that leads from the parent to the node
+            - 'player': the player that made that action, whose wins are counted in 'wins'
+            - 'first_child', 'child_count': the children of the node, 'child_count' is -1 until it is expanded
+            - 'visits', 'wins': how many rollouts went through the node and how many of them 'player' won
+        """
+        self.parent = [-1]
+        self.action = [None]
+        self.player = [-1]
+        self.first_child = [0]
+        self.child_count = [-1]
+        self.visits = [0]
+        self.wins = [0.0]
+
+    def __len__(self):
+        return len(self.parent)
+
+    def expand(self, node, actions, player):
+        """
+        Adds a child for every action of 'player' to 'node'
+        """
+        self.first_child[node] = len(self.parent)
+        self.child_count[node] = len(actions)
+        for action in actions:
+            self.parent.append(node)
+            self.action.append(action)
+            self.player.append(player)
+            self.first_child.append(0)
+            self.child_count.append(-1)
+            self.visits.append(0)
+            self.wins.append(0.0)
+
+    def share(self, node, other):
+        """
+        Gives 'node' the children of 'other', a node of the same position that was reached through other moves
+        """
+        self.first_child[node] = self.first_child[other]
+        self.child_count[node] = self.child_count[other]
+
+    def select_child(self, node, exploration, widening=None):
+        """
+        Returns the child with the highest UCT value, unvisited children first.
+        With 'widening' only the first '2 + widening * sqrt(visits)' children can be picked, so a node with many children
+        tries its first (best ordered) children more often before the others (progressive widening).
+        """
+        first = self.first_child[node]
+        count = self.child_count[node]
+        if widening is not None:
+            count = min(count, 2 + int(widening * math.sqrt(self.visits[node])))
+        log_visits = math.log(self.visits[node] or 1)
+        best, best_value = first, -1.0
+        for child in range(first, first + count):
+            visits = self.visits[child]
+            if visits == 0:
+                return child
+            value = self.wins[child] / visits + exploration * math.sqrt(log_visits / visits)
+            if value > best_value:
+                best, best_value = child, value
+        return best
+
+    def root_children(self):
+        """
+        Returns '(action, visits, wins)' of every child of the root
+        """
+        first = self.first_child[0]
+        return [(self.action[child], self.visits[child], self.wins[child])
+                for child in range(first, first + max(self.child_count[0], 0))]
+
+class MCTSPlayer():
+    # Below this batch size the rollouts are faster one by one than in a 'BatchedAzul'
+    BATCHED_MIN_SIZE = 128
+    # Fraction of the rollout moves that are random instead of the move with the highest 'Azul.immediate_gain()'
+    ROLLOUT_EPSILON = 0.2
+
+    def __init__(self, iterations=1000, time_limit=None, batch_size=32, exploration=1.4, workers=1, seed=None, batched=None,
+                 table_size=1 << 14, widening=1.0):
+        """
+        AI that picks a move with Monte Carlo Tree Search using UCT.
+
+        Every move is searched for 'iterations' rollouts, or until 'time_limit' seconds have passed when it is set.
+        The tree only grows within the current round, because the next round starts with random tiles:
+        a move that ends the round is always a leaf and is valued with rollouts.
+        The tree only has the moves of 'Azul.pruned_actions()', ordered by 'Azul.immediate_gain()'. Every iteration
+        expands one node; with 'widening' a node only tries more of its moves as its visits grow ('SearchTree.select_child()').
+        Rollouts play the move with the highest immediate gain, or a random move 'ROLLOUT_EPSILON' of the time.
+
+        Leaves are collected in batches of 'batch_size' before their rollouts are played. Nodes on the path to a
+        collected leaf get their visit right away (a virtual loss), so the batch spreads over the tree.
+        With 'batched' the rollouts of a batch are played at once by 'BatchedAzul' (this needs NumPy and the standard wall),
+        otherwise they are played one by one. The batched rollouts play random moves.
+        By default the batched simulator is used when it is available and the batches have at least 'BATCHED_MIN_SIZE' leaves.
+
+        Positions that are reached through different move orders share their children, they are found by their
+        Zobrist key in a transposition table of 'table_size' entries. A 'table_size' of 0 turns this off.
+
+        With more than 1 worker every worker process searches its own tree from the same position
+        and the visits of the moves at the root are added up (root parallelism).
+        """
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.batch_size = batch_size
+        self.exploration = exploration
+        self.workers = workers
+        self.batched = batched
+        self.rng = random.Random(seed)
+        self.pool = None
+        self.table = TranspositionTable(table_size) if table_size else None
+        self.widening = widening
+
+    def choose_move(self, game):
+        """
+        Returns the move with the most visits after searching from the position of 'game'
+        """
+        if self.workers > 1:
+            children = self.parallel_search(game)
+        else:
+            children = self.search(game).root_children()
+
+        if not children:
+            return None
+        visits = {}
+        for action, action_visits, wins in children:
+            visits[action] = visits.get(action, 0) + action_visits
+        return max(visits, key=visits.get)
+
+    def parallel_search(self, game):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        seeds = [self.rng.getrandbits(32) for i in range(self.workers)]
+        settings = (self.iterations, self.time_limit, self.batch_size, self.exploration, self.batched,
+                    len(self.table.depths) if self.table is not None else 0, self.widening)
+        results = self.pool.map(_search_root, [(game, settings, seed) for seed in seeds])
+        return [child for children in results for child in children]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def search(self, game):
+        """
+        Searches from the position of 'game' and returns the search tree.
+        The game is used to play out the search, it is back at its position when the search is done.
+        """
+        tree = SearchTree()
+        if self.table is not None:
+            # Node numbers are only valid within one search
+            self.table.clear()
+        batched = self.batched
+        if batched is None:
+            batched = BatchedAzul is not None and game.difficulty == 0 and self.batch_size >= MCTSPlayer.BATCHED_MIN_SIZE
+        deadline = None if self.time_limit is None else time.perf_counter() + self.time_limit
+
+        iterations = 0
+        while iterations < self.iterations or deadline is not None:
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            size = self.batch_size if deadline is not None else min(self.batch_size, self.iterations - iterations)
+
+            # Collect the paths to a batch of leaves, the leaves that need a rollout are copied into the batch
+            sim = None
+            if batched:
+                sim = BatchedAzul(size, game.num_players, self.rng.getrandbits(32))
+                # Slots without a leaf count as finished games
+                sim.winner[:] = 0
+            paths = []
+            winners = []
+            for i in range(size):
+                path, winner = self.select(tree, game, sim, i)
+                paths.append(path)
+                winners.append(winner)
+
+            # Play the rollouts of the batch at once
+            if batched:
+                results = sim.play_out()
+                winners = [int(results[i]) if winner is None else winner for i, winner in enumerate(winners)]
+
+            for path, winner in zip(paths, winners):
+                for node in path:
+                    if tree.player[node] == winner:
+                        tree.wins[node] += 1
+            iterations += size
+
+        return tree
+
+    def select(self, tree, game, sim, slot):
+        """
+        Walks down the tree from the root to a leaf with UCT. A leaf inside the current round is expanded and the walk
+        ends at one of its new children, so every iteration adds one node to the path and the rest is played by the rollout.
+        Returns the path of nodes and the winner. When the game isn't over at the leaf, it is copied into game 'slot'
+        of the batch 'sim' and the winner is None, without a batch it is rolled out right away.
+        """
+        node = 0
+        path = [0]
+        undo = []
+        tree.visits[0] += 1
+        ended_round = False
+        expanded = False
+        while game.winner is None and not ended_round and not expanded:
+            if tree.child_count[node] < 0:
+                entry = self.table.probe(game.zobrist) if self.table is not None else None
+                if entry is not None:
+                    # The children of the same position reached through other moves already have statistics
+                    tree.share(node, entry[1])
+                else:
+                    actions = Azul.pruned_actions(game.boards[game.player], game.factories, game.floor)
+                    # The moves that gain the most points this round are tried first
+                    gains = [game.immediate_gain(action) for action in actions]
+                    actions = [actions[i] for i in sorted(range(len(actions)), key=lambda i: -gains[i])]
+                    tree.expand(node, actions, game.player)
+                    expanded = True
+                    if self.table is not None:
+                        self.table.store(game.zobrist, 0, node)
+            if tree.child_count[node] == 0:
+                break
+            node = tree.select_child(node, self.exploration, self.widening)
+            path.append(node)
+            tree.visits[node] += 1
+            record = game.make_move(tree.action[node], trusted=True)
+            undo.append(record)
+            ended_round = record[-1] is not None
+
+        winner = game.winner
+        if winner is None:
+            if sim is not None:
+                sim.set_game(slot, game)
+            else:
+                winner = self.rollout(game)
+
+        for record in reversed(undo):
+            game.unmake_move(record)
+        return path, winner
+
+    def rollout(self, game):
+        """
+        Plays random moves until the game is over and returns the winner, the game is put back afterwards
+        """
+        rng_state = game.rng.getstate()
+        game.rng.seed(self.rng.getrandbits(32))
+        undo = []
+        while game.winner is None:
+            actions = Azul.pruned_actions(game.boards[game.player], game.factories, game.floor)
+            if not actions:
+                break
+            action = self.rng.choice(actions)
+            if self.rng.random() >= MCTSPlayer.ROLLOUT_EPSILON:
+                gains = [game.immediate_gain(action) for action in actions]
+                best = max(gains)
+                action = self.rng.choice([action for action, gain in zip(actions, gains) if gain == best])
+            undo.append(game.make_move(action, trusted=True))
+        winner = game.winner
+        for record in reversed(undo):
+            game.unmake_move(record)
+        game.rng.setstate(rng_state)
+        return winner
+
+def _search_root(args):
+    game, (iterations, time_limit, batch_size, exploration, batched, table_size, widening), seed = args
+    player = MCTSPlayer(iterations, time_limit, batch_size, exploration, seed=seed, batched=batched, table_size=table_size,
+                        widening=widening)
+    return player.search(game).root_children()
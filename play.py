@@ -1,4 +1,21 @@
-from azul import train, play
+import os
+import sys
 
-ai = train(10000)
+from azul import NimAI, train, play
+from instrumentation import TrainingMonitor
+
+QTABLE = "azul.qtable"
+
+if "--mcts" in sys.argv:
+    from endgame import EndgamePlayer, EndgameSolver
+    from mcts import MCTSPlayer
+    # Search every move for about a second, the end of a round is solved exactly when that fits in a second
+    ai = EndgamePlayer(MCTSPlayer(time_limit=1), solver=EndgameSolver(time_limit=1))
+elif os.path.exists(QTABLE):
+    ai = NimAI.load(QTABLE)
+else:
+    # Report progress every 10 seconds
+    monitor = TrainingMonitor(callback=lambda snapshot: print(f"Trained {snapshot['games']} games"), interval=10)
+    ai = train(10000, monitor=monitor)
+    ai.save(QTABLE)
 play(ai)
@@ -0,0 +1,225 @@
+import argparse
+import asyncio
+import json
+
+from azul import Azul
+
+def batch_policy(ai):
+    """
+    Returns a function that chooses a move for every game of a list at once.
+    AIs with 'best_actions(states)', like 'LinearAI', evaluate the whole batch in one go,
+    other AIs choose the moves one by one with 'choose_move(game)'.
+    """
+    if hasattr(ai, "best_actions"):
+        return lambda games: ai.best_actions([game.state() for game in games])
+    return lambda games: [ai.choose_move(game) for game in games]
+
+class MoveBatcher():
+
+    def __init__(self, policy, batch_size=64, max_delay=0.005):
+        """
+        Collects the AI moves that sessions wait for and lets 'policy' choose them in batches.
+        A batch is evaluated as soon as it has 'batch_size' games, or 'max_delay' seconds after its first game,
+        so no session waits for a full batch longer than that.
+        """
+        self.policy = policy
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.batches = 0
+        self.requests = 0
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def choose_move(self, game):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((game, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.requests += len(batch)
+            # The AI runs in a thread, so the sessions keep being served while it thinks
+            try:
+                actions = await loop.run_in_executor(None, self.policy, [game for game, future in batch])
+            except Exception as error:
+                for game, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            # A session that disconnected has cancelled its future
+            for (game, future), action in zip(batch, actions):
+                if not future.done():
+                    future.set_result(action)
+
+class Session():
+    __slots__ = ("game", "seat")
+
+    def __init__(self, game, seat):
+        """
+        A game played by one client, who plays seat 'seat', against the AI in all other seats
+        """
+        self.game = game
+        self.seat = seat
+
+def game_view(session):
+    """
+    Returns the position of a session as a dict that can be sent as JSON
+    """
+    game = session.game
+    view = {
+        "type": "state",
+        "seat": session.seat,
+        "player": game.player,
+        "winner": game.winner,
+        "factories": [[factory.count(color) for color in Azul.COLORS] for factory in game.factories],
+        "floor": [game.floor.count(color) for color in Azul.COLORS],
+        "start_tile": game.floor.start_player,
+        "boards": [{
+            "score": board.score,
+            "wall": [[board.wall_color(row, column) for column in range(5)] for row in range(5)],
+            "piles": [list(board.pile(p)) for p in range(5)],
+            "floor_line": board.foul_count(),
+        } for board in game.boards],
+    }
+    if game.winner is None and game.player == session.seat:
+        view["actions"] = Azul.available_actions(game.boards[game.player], game.factories, game.floor)
+    return view
+
+class GameServer():
+    HELP = "commands: new [players] [seed] [seat] | state | move <color> <factory> <pile> | quit"
+
+    def __init__(self, ai, batch_size=64, max_delay=0.005):
+        """
+        Line based game server: every connection is a session that sends one command per line
+        and gets one JSON object per line back. The moves of the AI for all sessions are chosen in batches.
+        """
+        self.batcher = MoveBatcher(batch_policy(ai), batch_size, max_delay)
+        self.sessions = 0
+        self.games = 0
+
+    async def start(self, host="127.0.0.1", port=7777):
+        self.batcher.start()
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self, server):
+        server.close()
+        await server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        session = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().split()
+                if not command:
+                    continue
+                if command[0] == "quit":
+                    break
+                try:
+                    session, response = await self.execute(session, command)
+                except ValueError as error:
+                    response = {"type": "error", "message": str(error)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def execute(self, session, command):
+        """
+        Runs a command of a session and returns the session and the response
+        """
+        name, arguments = command[0], command[1:]
+        try:
+            numbers = [int(argument) for argument in arguments]
+        except ValueError:
+            raise ValueError(f"Arguments must be numbers. {GameServer.HELP}")
+
+        if name == "new":
+            num_players, seed, seat = (numbers + [2, None, 0][len(numbers):])[:3]
+            if not 0 <= seat < num_players:
+                raise ValueError("Seat must be one of the players")
+            session = Session(Azul(num_players, seed=seed), seat)
+            self.games += 1
+        elif session is None:
+            raise ValueError(f"Start a game first. {GameServer.HELP}")
+        elif name == "move":
+            if len(numbers) != 3:
+                raise ValueError("A move is: move <color> <factory> <pile>")
+            game = session.game
+            if game.winner is not None or game.player != session.seat:
+                raise ValueError("It isn't your turn")
+            if not game.is_valid_action(tuple(numbers)):
+                raise ValueError("Invalid move")
+            game.move(tuple(numbers), trusted=True)
+        elif name != "state":
+            raise ValueError(f"Unknown command. {GameServer.HELP}")
+
+        await self.play_ai(session)
+        return session, game_view(session)
+
+    async def play_ai(self, session):
+        """
+        Lets the AI move until it is the turn of the client or the game is over
+        """
+        game = session.game
+        while game.winner is None and game.player != session.seat:
+            game.move(await self.batcher.choose_move(game), trusted=True)
+
+async def serve(ai, host, port):
+    server = GameServer(ai)
+    tcp_server = await server.start(host, port)
+    print(f"Serving Azul on {host}:{port}")
+    async with tcp_server:
+        await tcp_server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Azul game server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--ai", choices=["greedy", "linear", "nimai"], default="greedy")
+    parser.add_argument("--model", help="weights of the linear AI or Q-table of the nimai AI")
+    args = parser.parse_args(argv)
+
+    if args.ai == "linear":
+        from approximator import LinearAI
+        ai = LinearAI.load(args.model) if args.model else LinearAI()
+    elif args.ai == "nimai":
+        from azul import NimAI
+        ai = NimAI.load(args.model or "azul.qtable")
+    else:
+        from arena import GreedyPlayer
+        ai = GreedyPlayer()
+    asyncio.run(serve(ai, args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+import numpy as np
+
+from azul import (Azul, COUNT_BITS, ROW_MASKS, COLUMN_MASKS, COLOR_MASKS, COLUMN_GATHER, RUN_SCORE,
+                  FLOOR_PENALTIES, FLOOR_LINE_SIZE, ROW_BONUS, COLUMN_BONUS, COLOR_BONUS)
+
+# An action is encoded as one int: '(factory * 5 + color) * 6 + pile', where the floor is the last factory
+NUM_PILES = Azul.FLOOR_LINE + 1
+ACTIONS_PER_FACTORY = len(Azul.COLORS) * NUM_PILES
+
+# CELL_BITS[color, row] is the wall bit where 'color' goes in line 'row' of the standard wall
+CELL_BITS = np.array([[1 << (row * 5 + (color + row) % 5) for row in range(5)] for color in Azul.COLORS], dtype=np.int64)
+COLOR_IDS = np.arange(len(Azul.COLORS))
+CAPACITY = np.arange(1, 6)
+RUN_SCORE_TABLE = np.array(RUN_SCORE, dtype=np.int32)
+FLOOR_PENALTY_TABLE = np.array(FLOOR_PENALTIES, dtype=np.int32)
+
+class BatchedAzul():
+
+    def __init__(self, num_games, num_players = 2, seed = None):
+        """
+        Initializes 'num_games' games of Azul that are all stepped at once.
+        Only the standard wall (difficulty 0) is supported, so the wall of a player is just its occupancy bits.
+
+        Every array has the game as its first axis:
+            - 'factories': tile counts per factory and color, the last factory is the floor
+            - 'start_tile': whether the start player tile is still on the floor
+            - 'player', 'first_player': whose turn it is and who starts the next round
+            - 'winner': the winning player, or -1 while the game is running
+            - 'walls': 25-bit wall occupancy per player
+            - 'pile_counts', 'pile_colors': the 5 piles of every player
+            - 'foul_tiles', 'foul_counts', 'foul_start': foul tiles per color, the total on the floor line
+              and whether the start player tile is on the floor line
+            - 'scores': score per player
+            - 'bag', 'lid': tile counts per color in the bag and in the box lid
+        All games draw their tiles from one numpy random generator seeded with 'seed'.
+        """
+        if num_players > 4 or num_players < 2:
+            raise ValueError("Number of players must be 2, 3 or 4")
+
+        n = num_games
+        self.num_games = num_games
+        self.num_players = num_players
+        self.num_factories = 2 * num_players + 1
+        self.rng = np.random.default_rng(seed)
+
+        self.factories = np.zeros((n, self.num_factories + 1, len(Azul.COLORS)), dtype=np.int16)
+        self.start_tile = np.ones(n, dtype=bool)
+        self.player = np.zeros(n, dtype=np.int64)
+        self.first_player = np.zeros(n, dtype=np.int64)
+        self.winner = np.full(n, -1, dtype=np.int64)
+        self.walls = np.zeros((n, num_players), dtype=np.int64)
+        self.pile_counts = np.zeros((n, num_players, 5), dtype=np.int16)
+        self.pile_colors = np.zeros((n, num_players, 5), dtype=np.int16)
+        self.foul_tiles = np.zeros((n, num_players, len(Azul.COLORS)), dtype=np.int16)
+        self.foul_counts = np.zeros((n, num_players), dtype=np.int16)
+        self.foul_start = np.zeros((n, num_players), dtype=bool)
+        self.scores = np.zeros((n, num_players), dtype=np.int32)
+        self.bag = np.full((n, len(Azul.COLORS)), 20, dtype=np.int16)
+        self.lid = np.zeros((n, len(Azul.COLORS)), dtype=np.int16)
+
+        self.fill_factories(np.arange(n))
+
+    @classmethod
+    def from_games(cls, games, seed = None):
+        """
+        Builds a batch from a list of 'Azul' games with the same number of players
+        """
+        sim = cls(len(games), games[0].num_players, seed)
+        for i, game in enumerate(games):
+            sim.set_game(i, game)
+        return sim
+
+    def set_game(self, i, game):
+        """
+        Copies the position of an 'Azul' game into game 'i' of the batch
+        """
+        if game.difficulty != 0:
+            raise ValueError("Only the standard wall (difficulty 0) can be simulated in a batch")
+        if game.num_players != self.num_players:
+            raise ValueError(f"Game has {game.num_players} players instead of {self.num_players}")
+
+        for j, factory in enumerate(game.factories + [game.floor]):
+            self.factories[i, j] = [factory.count(color) for color in Azul.COLORS]
+        self.start_tile[i] = game.floor.start_player
+        self.player[i] = game.player
+        self.first_player[i] = game.first_player
+        self.winner[i] = -1 if game.winner is None else game.winner
+        for p, board in enumerate(game.boards):
+            self.walls[i, p] = board.occupied
+            for row in range(5):
+                color, count = board.pile(row)
+                self.pile_counts[i, p, row] = count
+                self.pile_colors[i, p, row] = color if count else 0
+            self.foul_tiles[i, p] = [board.foul_tile_count(color) for color in Azul.COLORS]
+            self.foul_counts[i, p] = board.foul_count()
+            self.foul_start[i, p] = board.foul_tile_count(Azul.START_PLAYER_TILE) > 0
+            self.scores[i, p] = board.score
+        self.bag[i] = [game.bag.count(color) for color in Azul.COLORS]
+        self.lid[i] = [game.bag.lid_count(color) for color in Azul.COLORS]
+
+    def to_game(self, i):
+        """
+        Returns game 'i' of the batch as an 'Azul' game
+        """
+        game = Azul(self.num_players)
+        for p, board in enumerate(game.boards):
+            occupied = int(self.walls[i, p])
+            for row in range(5):
+                for column in range(5):
+                    if occupied >> (row * 5 + column) & 1:
+                        board.place_on_wall(row, (column - row) % 5, column)
+                count = int(self.pile_counts[i, p, row])
+                if count:
+                    board.set_pile(row, int(self.pile_colors[i, p, row]), count)
+            for color in Azul.COLORS:
+                board.add_foul_tiles(color, int(self.foul_tiles[i, p, color]))
+            if self.foul_start[i, p]:
+                board.add_foul_tiles(Azul.START_PLAYER_TILE, 1)
+            board.score = int(self.scores[i, p])
+
+        for j, factory in enumerate(game.factories + [game.floor]):
+            factory.tiles = self.pack(self.factories[i, j])
+        game.floor.start_player = bool(self.start_tile[i])
+        game.bag.bag = self.pack(self.bag[i])
+        game.bag.bag_size = int(self.bag[i].sum())
+        game.bag.lid = self.pack(self.lid[i])
+        game.bag.lid_size = int(self.lid[i].sum())
+        game.player = int(self.player[i])
+        game.first_player = int(self.first_player[i])
+        game.winner = None if self.winner[i] < 0 else int(self.winner[i])
+        game.zobrist = game.compute_zobrist()
+        return game
+
+    @staticmethod
+    def pack(counts):
+        return sum(int(count) << (color * COUNT_BITS) for color, count in enumerate(counts))
+
+    def encode_action(self, action):
+        """
+        Returns the int for an action '(color, factory, pile)' of 'Azul'
+        """
+        color, factory, pile = action
+        if factory == Azul.FLOOR:
+            factory = self.num_factories
+        return (factory * len(Azul.COLORS) + color) * NUM_PILES + pile
+
+    def decode_action(self, action):
+        """
+        Returns the 'Azul' action '(color, factory, pile)' for an int
+        """
+        factory, rest = divmod(int(action), ACTIONS_PER_FACTORY)
+        color, pile = divmod(rest, NUM_PILES)
+        if factory == self.num_factories:
+            factory = Azul.FLOOR
+        return (color, factory, pile)
+
+    def legal_mask(self):
+        """
+        Returns a (games, actions) boolean array with the available actions of the current player of every game.
+        Finished games have no available actions.
+        """
+        n = self.num_games
+        games = np.arange(n)
+        walls = self.walls[games, self.player]
+        counts = self.pile_counts[games, self.player]
+        colors = self.pile_colors[games, self.player]
+
+        # (games, colors, piles)
+        in_row = (walls[:, None, None] & CELL_BITS[None]) != 0
+        same_color = (colors[:, None, :] == COLOR_IDS[None, :, None]) & (counts < CAPACITY)[:, None, :]
+        receivable = np.where((counts == 0)[:, None, :], ~in_row, same_color)
+        piles = np.concatenate([receivable, np.ones((n, len(Azul.COLORS), 1), dtype=bool)], axis=2)
+
+        mask = (self.factories > 0)[:, :, :, None] & piles[:, None, :, :]
+        mask[self.winner >= 0] = False
+        return mask.reshape(n, -1)
+
+    def random_actions(self, mask = None):
+        """
+        Picks a uniformly random available action in every game, -1 for finished games
+        """
+        if mask is None:
+            mask = self.legal_mask()
+        # Available actions get a value in [1, 2), the others in [0, 1)
+        values = self.rng.random(mask.shape, dtype=np.float32)
+        values += mask
+        actions = values.argmax(axis=1)
+        actions[self.winner >= 0] = -1
+        return actions
+
+    def policy_actions(self, values, mask = None):
+        """
+        Picks the available action with the highest value in every game, -1 for finished games.
+        'values' is a (games, actions) array, for instance the output of a policy for the whole batch.
+        """
+        if mask is None:
+            mask = self.legal_mask()
+        actions = np.where(mask, values, -np.inf).argmax(axis=1)
+        actions[~mask.any(axis=1)] = -1
+        return actions
+
+    def step(self, actions):
+        """
+        Makes move 'actions[i]' in game 'i' like 'Azul.move()', games with action -1 are skipped.
+        Actions are not validated, they must come from 'legal_mask()'.
+        """
+        games = np.flatnonzero(actions >= 0)
+        if len(games) == 0:
+            return
+        factory, rest = np.divmod(actions[games], ACTIONS_PER_FACTORY)
+        color, pile = np.divmod(rest, NUM_PILES)
+        player = self.player[games]
+        floor = self.num_factories
+
+        # 1. Take tiles from the factory, the rest of the factory goes to the floor
+        count = self.factories[games, factory, color].astype(np.int16)
+        self.factories[games, factory, color] = 0
+        from_factory = factory != floor
+        fg, ff = games[from_factory], factory[from_factory]
+        self.factories[fg, floor] += self.factories[fg, ff]
+        self.factories[fg, ff] = 0
+
+        # 2. Add them to the pile
+        to_pile = pile < Azul.FLOOR_LINE
+        row = np.minimum(pile, 4)
+        current = self.pile_counts[games, player, row]
+        fits = np.where(to_pile, np.minimum(count, row + 1 - current), 0).astype(np.int16)
+        pg, pp, pr = games[to_pile], player[to_pile], row[to_pile]
+        self.pile_counts[pg, pp, pr] += fits[to_pile]
+        self.pile_colors[pg, pp, pr] = color[to_pile]
+
+        # 3. Tiles that don't fit are foul tiles, once the floor line is full they go to the lid
+        overflow = count - fits
+        fouled = np.minimum(overflow, FLOOR_LINE_SIZE - self.foul_counts[games, player])
+        self.foul_tiles[games, player, color] += fouled
+        self.foul_counts[games, player] += fouled
+        self.lid[games, color] += overflow - fouled
+
+        # 4. The start player tile
+        took = (factory == floor) & self.start_tile[games]
+        tg, tp = games[took], player[took]
+        self.start_tile[tg] = False
+        self.first_player[tg] = tp
+        fits_start = self.foul_counts[tg, tp] < FLOOR_LINE_SIZE
+        self.foul_start[tg[fits_start], tp[fits_start]] = True
+        self.foul_counts[tg[fits_start], tp[fits_start]] += 1
+
+        ended = self.factories[games].sum(axis=(1, 2)) == 0
+        self.player[games[~ended]] = (player[~ended] + 1) % self.num_players
+        if ended.any():
+            self.end_round(games[ended])
+
+    def end_round(self, games):
+        self.score_round(games)
+
+        over = self.is_end_game(games)
+        self.end_game(games[over])
+
+        games = games[~over]
+        self.fill_factories(games)
+        self.start_tile[games] = True
+        self.player[games] = self.first_player[games]
+
+        # Only happens when all tiles are stuck on the boards
+        stuck = self.factories[games].sum(axis=(1, 2)) == 0
+        self.end_game(games[stuck])
+
+    def score_round(self, games):
+        for p in range(self.num_players):
+            added_score = np.zeros(len(games), dtype=np.int32)
+            for row in range(5):
+                full = self.pile_counts[games, p, row] == row + 1
+                fg = games[full]
+                color = self.pile_colors[fg, p, row].astype(np.int64)
+                column = (color + row) % 5
+                walls = self.walls[fg, p] | (np.int64(1) << (row * 5 + column))
+                self.walls[fg, p] = walls
+
+                row_bits = (walls >> (row * 5)) & 0b11111
+                column_bits = ((((walls >> column) & COLUMN_MASKS[0]) * COLUMN_GATHER) >> 20) & 0b11111
+                points = RUN_SCORE_TABLE[row_bits, column] + RUN_SCORE_TABLE[column_bits, row]
+                added_score[full] += np.where(points == 0, 1, points)
+
+                self.lid[fg, color] += row
+                self.pile_counts[fg, p, row] = 0
+
+            added_score += FLOOR_PENALTY_TABLE[self.foul_counts[games, p]]
+            self.scores[games, p] = np.maximum(0, self.scores[games, p] + added_score)
+            self.lid[games] += self.foul_tiles[games, p]
+            self.foul_tiles[games, p] = 0
+            self.foul_counts[games, p] = 0
+            self.foul_start[games, p] = False
+
+    def complete_lines(self, walls, masks):
+        return sum(((walls & mask) == mask).astype(np.int32) for mask in masks)
+
+    def is_end_game(self, games):
+        return (self.complete_lines(self.walls[games], ROW_MASKS) > 0).any(axis=1)
+
+    def end_game(self, games):
+        if len(games) == 0:
+            return
+        walls = self.walls[games]
+        rows = self.complete_lines(walls, ROW_MASKS)
+        self.scores[games] += (ROW_BONUS * rows + COLUMN_BONUS * self.complete_lines(walls, COLUMN_MASKS)
+                               + COLOR_BONUS * self.complete_lines(walls, COLOR_MASKS))
+        # Ties are won by the player with the most complete horizontal rows
+        self.winner[games] = (self.scores[games] * 8 + rows).argmax(axis=1)
+
+    def fill_factories(self, games):
+        """
+        Fills every factory of the given games with 4 tiles from the bag, refilling the bag from the lid when it is empty
+        """
+        for j in range(self.num_factories):
+            for t in range(4):
+                self.draw_tile(games, j)
+
+    def draw_tile(self, games, factory):
+        empty = self.bag[games].sum(axis=1) == 0
+        if empty.any():
+            eg = games[empty]
+            self.bag[eg] = self.lid[eg]
+            self.lid[eg] = 0
+
+        bag = self.bag[games]
+        total = bag.sum(axis=1)
+        has_tiles = total > 0
+        games, bag, total = games[has_tiles], bag[has_tiles], total[has_tiles]
+        r = (self.rng.random(len(games)) * total).astype(np.int64)
+        color = (bag.cumsum(axis=1) <= r[:, None]).sum(axis=1)
+        self.bag[games, color] -= 1
+        self.factories[games, factory, color] += 1
+
+    def is_done(self):
+        return bool((self.winner >= 0).all())
+
+    def play_out(self, policy = None):
+        """
+        Plays all games until they are finished and returns the winners.
+        'policy' gets the batch and the legal mask and returns an action per game, by default random moves are played.
+        """
+        while not self.is_done():
+            mask = self.legal_mask()
+            if policy is None:
+                actions = self.random_actions(mask)
+            else:
+                actions = policy(self, mask)
+            self.step(actions)
+        return self.winner
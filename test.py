@@ -1,33 +1,74 @@
-from azul import Azul, PlayerBoard, TileFactory
+from azul import Azul, PlayerBoard, TileFactory, TileBag, NimAI, StateValues, BoundedQStore, TranspositionTable, self_play, train
+import json
+import random
 import pytest
 
+def play_random_game(game, rng):
+    while game.winner is None:
+        actions = sorted(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+        game.move(rng.choice(actions))
+    return game
+
+def count_tiles(game):
+    """
+    Counts the tiles of every color in the bag, lid, factories, floor, piles, floor lines and walls
+    """
+    counts = []
+    for color in Azul.COLORS:
+        total = game.bag.count(color) + game.bag.lid_count(color) + game.floor.count(color)
+        total += sum(factory.count(color) for factory in game.factories)
+        for board in game.boards:
+            total += board.foul_tile_count(color)
+            total += sum(board.pile(p)[1] for p in range(5) if board.pile(p)[0] == color)
+            total += sum(board.wall_color(r, c) == color for r in range(5) for c in range(5))
+        counts.append(total)
+    return counts
+
 def test_save_tiles_to_pile():
     board = PlayerBoard()
     board.save_tiles_to_pile(0, Azul.BLUE, 1)
-    assert board.piles[0] == {"color": Azul.BLUE, "count": 1}
+    assert board.pile(0) == (Azul.BLUE, 1)
     with pytest.raises(OverflowError):
         board.save_tiles_to_pile(0, Azul.BLUE, 1)
-    assert board.piles[0] == {"color": Azul.BLUE, "count": 1}
-    assert board.piles[1] == {"color": Azul.EMPTY, "count": 0}
+    assert board.pile(0) == (Azul.BLUE, 1)
+    assert board.pile(1) == (Azul.EMPTY, 0)
     with pytest.raises(ValueError):
         board.save_tiles_to_pile(1, Azul.BLUE, 1)
     board.save_tiles_to_pile(4, Azul.RED, 5)
-    assert board.piles[4] == {"color": Azul.RED, "count": 5}
+    assert board.pile(4) == (Azul.RED, 5)
     board.save_tiles_to_pile(2, Azul.WHITE, 1)
     with pytest.raises(ValueError):
         board.save_tiles_to_pile(2, Azul.BLACK, 1)
-    assert board.piles[2] == {"color": Azul.WHITE, "count": 1}
+    assert board.pile(2) == (Azul.WHITE, 1)
 
-def test_save_tiles_to_pile():
+def test_save_tiles_to_pile_wall():
     board = PlayerBoard()
-    board.wall[0][1] = Azul.BLUE
+    board.place_on_wall(0, Azul.BLUE, 1)
     with pytest.raises(OverflowError):
         board.save_tiles_to_pile(0, Azul.BLUE, 1)
     board.save_tiles_to_pile(0, Azul.RED, 1)
 
 def test_tile_factory():
+    fac = TileFactory(bag=TileBag(random.Random(0)))
+    assert fac.tile_count() == 4
+    assert sum(fac.count(color) for color in fac.colors()) == 4
+
+def test_take_tiles():
     fac = TileFactory()
-    assert len(fac.tiles) == 4
+    floor = TileFactory(True)
+    fac.tiles = 0
+    fac.tiles += 2 << (Azul.RED * 5)
+    fac.tiles += 1 << (Azul.BLUE * 5)
+    fac.tiles += 1 << (Azul.WHITE * 5)
+    assert fac.take_tiles(Azul.RED, floor) == 2
+    assert not fac.has_tiles()
+    assert floor.colors() == [Azul.BLUE, Azul.WHITE]
+    assert floor.start_player
+    floor.drop_tiles_on_floor(Azul.BLUE, 2)
+    assert floor.take_tiles(Azul.BLUE, floor) == 3
+    assert floor.colors() == [Azul.WHITE]
+    with pytest.raises(TypeError):
+        fac.drop_tiles_on_floor(Azul.RED, 1)
 
 def test_piles_that_can_receive_color():
     game = Azul()
@@ -52,25 +93,825 @@ def test_available_actions():
     game = Azul()
     board = game.boards[game.player]
     actions = game.available_actions(board, game.factories, game.floor)
-    for (color, factory_or_floor, pile) in actions:
-        if type(factory_or_floor) == TileFactory:
-            assert color in factory_or_floor.tiles
+    for (color, factory_index, pile) in actions:
+        factory = game.floor if factory_index == Azul.FLOOR else game.factories[factory_index]
+        assert factory.count(color) > 0
 
     # l = sorted(list(actions), key=lambda item: (item[0], item[1].tiles, item[2]))
     # print(l)
 
+def test_move_takes_whole_color():
+    game = Azul()
+    board = game.boards[0]
+    factory = game.factories[0]
+    factory.tiles = (2 << (Azul.RED * 5)) + (2 << (Azul.BLACK * 5))
+    game.move((Azul.RED, 0, 0))
+    assert board.pile(0) == (Azul.RED, 1)
+    assert board.foul_tile_count(Azul.RED) == 1
+    assert not factory.has_tiles()
+    assert game.floor.count(Azul.BLACK) == 2
+
+def test_tile_bag():
+    bag = TileBag(random.Random(0))
+    tiles = bag.draw_tiles(100)
+    assert all((tiles >> (color * 5)) & 31 == 20 for color in Azul.COLORS)
+    assert bag.draw() == -1
+    bag.discard(Azul.RED, 3)
+    assert [bag.draw() for i in range(4)] == [Azul.RED, Azul.RED, Azul.RED, -1]
+
+def test_seeded_games():
+    first = [factory.tiles for factory in Azul(seed=42).factories]
+    assert first == [factory.tiles for factory in Azul(seed=42).factories]
+    assert first != [factory.tiles for factory in Azul(seed=43).factories]
+
+    game = play_random_game(Azul(seed=42), random.Random(1))
+    again = play_random_game(Azul(seed=42), random.Random(1))
+    assert game.state() == again.state()
+
+def test_full_game_keeps_all_tiles():
+    for num_players in (2, 3, 4):
+        game = Azul(num_players, seed=num_players)
+        assert len(game.factories) == 2 * num_players + 1
+        rng = random.Random(0)
+        while game.winner is None:
+            assert count_tiles(game) == [20] * 5
+            actions = sorted(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+            game.move(rng.choice(actions))
+        assert any(board.has_entire_horizontal_row() for board in game.boards)
+
+def full_state(game):
+    return (game.state(), game.first_player, game.winner, game.bag.bag, game.bag.bag_size,
+            game.bag.lid, game.bag.lid_size, game.rng.getstate())
+
+def test_make_unmake_move():
+    game = Azul(3, seed=7)
+    rng = random.Random(2)
+    history = []
+    while game.winner is None:
+        before = full_state(game)
+        actions = sorted(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+        for action in actions[:5]:
+            undo = game.make_move(action)
+            game.unmake_move(undo)
+            assert full_state(game) == before
+        history.append((before, game.make_move(rng.choice(actions))))
+
+    for before, undo in reversed(history):
+        game.unmake_move(undo)
+        assert full_state(game) == before
+
+def test_is_valid_action():
+    game = Azul(seed=3)
+    while game.winner is None:
+        actions = Azul.available_actions(game.boards[game.player], game.factories, game.floor)
+        for color in Azul.COLORS:
+            for factory in range(Azul.FLOOR - 1, len(game.factories) + 1):
+                for pile in range(-1, Azul.FLOOR_LINE + 2):
+                    action = (color, factory, pile)
+                    assert game.is_valid_action(action) == (action in actions)
+        game.move(sorted(actions)[0], trusted=True)
+
+    with pytest.raises(Exception):
+        game.move(sorted(actions)[0])
+
+def test_move_rejects_invalid_actions():
+    game = Azul(seed=3)
+    with pytest.raises(Exception):
+        game.move((Azul.RED, len(game.factories), 0))
+    with pytest.raises(Exception):
+        game.move((Azul.RED, 0, 6))
+    empty = [c for c in Azul.COLORS if not game.factories[0].count(c)][0]
+    with pytest.raises(Exception):
+        game.move((empty, 0, 0))
+    with pytest.raises(Exception):
+        game.move((Azul.RED, Azul.FLOOR, 0))
+
+def test_receivable_piles_stay_up_to_date():
+    game = Azul(seed=11)
+    rng = random.Random(0)
+    while game.winner is None:
+        for board in game.boards:
+            for color in Azul.COLORS:
+                expected = []
+                for p in range(5):
+                    pile_color, count = board.pile(p)
+                    if count == 0 and not board.has_color_in_row(p, color) or pile_color == color and count < p + 1:
+                        expected.append(p)
+                assert board.piles_that_can_receive_color(color) == expected
+        actions = Azul.available_actions(game.boards[game.player], game.factories, game.floor)
+        assert len(actions) == len(set(actions))
+        game.move(rng.choice(actions))
+
+def naive_tile_score(board, row, column):
+    def filled(r, c):
+        return 0 <= r < 5 and 0 <= c < 5 and board.wall_color(r, c) != Azul.EMPTY
+    horizontal = 1
+    for step in (-1, 1):
+        c = column + step
+        while filled(row, c):
+            horizontal += 1
+            c += step
+    vertical = 1
+    for step in (-1, 1):
+        r = row + step
+        while filled(r, column):
+            vertical += 1
+            r += step
+    if horizontal > 1 and vertical > 1:
+        return horizontal + vertical
+    return max(horizontal, vertical)
+
+def test_tile_score():
+    rng = random.Random(5)
+    for i in range(200):
+        board = PlayerBoard()
+        cells = rng.sample([(r, c) for r in range(5) for c in range(5)], rng.randint(1, 25))
+        for row, column in cells:
+            board.place_on_wall(row, (column - row) % 5)
+            assert board.tile_score(row, column) == naive_tile_score(board, row, column)
+
+def test_score_round():
+    game = Azul(seed=0)
+    board = game.boards[0]
+    board.place_on_wall(0, Azul.YELLOW)
+    board.place_on_wall(1, Azul.BLUE)
+    board.place_on_wall(2, Azul.BLUE)
+    board.save_tiles_to_pile(0, Azul.BLUE, 1)
+    board.save_tiles_to_pile(2, Azul.WHITE, 3)
+    board.save_tiles_to_pile(3, Azul.RED, 2)
+    board.add_foul_tiles(Azul.BLACK, 3)
+    game.score_round()
+    # Blue in row 0 joins yellow: 2, white in row 2 makes a line of 2 and a column of 3: 5, floor line: -4
+    assert board.score == 3
+    assert board.pile(0) == (Azul.EMPTY, 0)
+    assert board.pile(3) == (Azul.RED, 2)
+    assert board.foul_count() == 0
+    assert game.bag.lid_count(Azul.WHITE) == 2
+    assert game.bag.lid_count(Azul.BLACK) == 3
+
+    board.add_foul_tiles(Azul.RED, 7)
+    game.score_round()
+    assert board.score == 0
+
+def test_score_end_game():
+    game = Azul(seed=0)
+    board = game.boards[1]
+    for row in range(5):
+        board.place_on_wall(row, Azul.RED)
+    for color in (Azul.BLUE, Azul.YELLOW, Azul.BLACK, Azul.WHITE):
+        board.place_on_wall(0, color)
+    for row in range(1, 5):
+        board.place_on_wall(row, (2 - row) % 5)
+    # One row, one column (column 2) and one color
+    assert (board.complete_rows(), board.complete_columns(), board.complete_colors()) == (1, 1, 1)
+    game.score_end_game()
+    assert board.score == 2 + 7 + 10
+    assert game.boards[0].score == 0
+
+def test_batched_simulator_matches_azul():
+    np = pytest.importorskip("numpy")
+    from simulator import BatchedAzul
+
+    for num_players in (2, 3):
+        games = [Azul(num_players, seed=seed) for seed in range(10)]
+        sim = BatchedAzul.from_games(games, seed=0)
+        rng = random.Random(0)
+        while any(game.winner is None for game in games):
+            mask = sim.legal_mask()
+            actions = np.full(len(games), -1)
+            for i, game in enumerate(games):
+                if game.winner is None:
+                    legal = sorted(Azul.available_actions(game.boards[game.player], game.factories, game.floor))
+                    assert sorted(sim.decode_action(a) for a in np.flatnonzero(mask[i])) == legal
+                    action = rng.choice(legal)
+                    actions[i] = sim.encode_action(action)
+                    game.move(action)
+                else:
+                    assert not mask[i].any()
+            sim.step(actions)
+            for i, game in enumerate(games):
+                simulated = sim.to_game(i)
+                assert [board.key() for board in simulated.boards] == [board.key() for board in game.boards]
+                assert (simulated.player, simulated.first_player, simulated.winner) == (game.player, game.first_player, game.winner)
+                # New rounds are dealt from a different random generator, continue from the tiles of the real game
+                sim.set_game(i, game)
+
+def test_batched_simulator_play_out():
+    np = pytest.importorskip("numpy")
+    from simulator import BatchedAzul
+
+    sim = BatchedAzul(50, 4, seed=1)
+    winners = sim.play_out()
+    assert ((winners >= 0) & (winners < 4)).all()
+    assert (sim.bag.sum() + sim.lid.sum() + sim.factories.sum() + sim.pile_counts.sum() + sim.foul_tiles.sum()
+            + sum(bin(int(wall)).count("1") for wall in sim.walls.flat)) == 50 * 100
+
+def test_self_play():
+    player = NimAI(seed=0)
+    transitions = self_play(player, Azul(seed=0), learn=False)
+    assert not player.q
+    assert transitions[-1][3] in (1, -1)
+    assert all(reward == 0 for (state, action, new_state, reward) in transitions[:-2])
+
+    self_play(player, Azul(seed=0))
+    assert player.q
+
+def test_parallel_training_is_deterministic():
+    first = train(6, seed=3, workers=2, batch_size=2, sync_interval=4)
+    second = train(6, seed=3, workers=2, batch_size=2, sync_interval=4)
+    assert first.q and dict(first.q.items()) == dict(second.q.items())
+
+def test_canonical_state_foul_tiles():
+    # The start player tile on the floor line doesn't run into the piles
+    keys = []
+    for count in (0, 1):
+        game = Azul(seed=0)
+        game.boards[0].add_foul_tiles(Azul.START_PLAYER_TILE, 1)
+        if count:
+            game.boards[0].set_pile(0, Azul.BLUE, count)
+        keys.append(Azul.canonical_state(game.state())[0])
+    assert keys[0] != keys[1]
+
+def test_update_prepared():
+    # Updating with transitions prepared by a worker gives the same Q-values as updating with the states
+    transitions = self_play(NimAI(seed=0), Azul(seed=4), learn=False)
+    first, second = NimAI(), NimAI(memory_budget=20000)
+    third = NimAI(memory_budget=20000)
+    for transition in transitions * 2:
+        first.update(*transition)
+        second.update(*transition)
+        third.update_prepared(*first.prepare_transition(*transition))
+    assert first.q and dict(first.q.items()) != dict(second.q.items())
+    assert dict(second.q.items()) == dict(third.q.items())
+
+    # Every update looks up the old and the new state once
+    lookups = second.q.hits + second.q.misses
+    second.update(*transitions[0])
+    assert second.q.hits + second.q.misses == lookups + 2
+    lookups = third.q.hits + third.q.misses
+    third.update_prepared(*first.prepare_transition(*transitions[0]))
+    assert third.q.hits + third.q.misses == lookups + 2
+
+def test_encode_action():
+    codes = set()
+    for color in Azul.COLORS:
+        for factory in range(Azul.FLOOR, 9):
+            for pile in range(Azul.FLOOR_LINE + 1):
+                code = Azul.encode_action((color, factory, pile))
+                assert Azul.decode_action(code) == (color, factory, pile)
+                codes.add(code)
+    assert len(codes) == max(codes) + 1
+
+def test_save_and_load_q_table(tmp_path):
+    player = NimAI(seed=0)
+    for seed in range(3):
+        self_play(player, Azul(seed=seed))
+    path = tmp_path / "azul.qtable"
+    player.save(path)
+
+    loaded = NimAI.load(path)
+    assert len(loaded.q) == len(player.q)
+    for key, value in player.q.items():
+        assert loaded.q[key] == pytest.approx(value, abs=1e-6)
+    state = Azul(seed=99).state()
+    action = Azul.state_actions(state)[0]
+    assert loaded.get_q_value(state, action) == 0
+
+    loaded.update_q_value(state, action, 0, 1, 0)
+    # States read from the file are counted once, new states are counted on top
+    assert len(loaded.q) == len(loaded.q.entries()) == len(player.q) + len(loaded.state_values(state)[0].codes)
+    loaded.save(tmp_path / "updated.qtable")
+    updated = NimAI.load(tmp_path / "updated.qtable")
+    assert len(updated.q) == len(player.q) + len(loaded.state_values(state)[0].codes)
+    assert updated.get_q_value(state, action) == pytest.approx(0.5)
+    loaded.q.close()
+    updated.q.close()
+
+def test_canonical_state_ignores_factory_order_and_seats():
+    game = Azul(seed=4)
+    game.move(sorted(Azul.available_actions(game.boards[0], game.factories, game.floor))[0])
+    key, colors, factories = Azul.canonical_state(game.state())
+
+    other = Azul(seed=4)
+    other.move(sorted(Azul.available_actions(other.boards[0], other.factories, other.floor))[0])
+    other.factories.reverse()
+    other.boards.reverse()
+    other.player = 0
+    other_key, other_colors, other_factories = Azul.canonical_state(other.state())
+    assert other_key == key
+
+    # Actions are encoded the same way in both
+    for action in Azul.available_actions(game.boards[game.player], game.factories, game.floor):
+        color, factory, pile = action
+        other_factory = factory if factory == Azul.FLOOR else len(game.factories) - 1 - factory
+        assert (Azul.canonical_action(action, colors, factories)
+                == Azul.canonical_action((color, other_factory, pile), other_colors, other_factories))
+
+def test_canonical_state_relabels_colors():
+    swap = {Azul.RED: Azul.BLUE, Azul.BLUE: Azul.RED}
+    def position(difficulty, colors):
+        game = Azul(difficulty=difficulty, seed=0)
+        for factory in game.factories:
+            factory.tiles = 0
+        game.factories[0].tiles = (3 << (colors.get(Azul.RED, Azul.RED) * 5)) + (1 << (Azul.WHITE * 5))
+        game.factories[1].tiles = 4 << (colors.get(Azul.BLUE, Azul.BLUE) * 5)
+        game.boards[0].place_on_wall(0, colors.get(Azul.RED, Azul.RED))
+        game.boards[1].save_tiles_to_pile(2, colors.get(Azul.BLUE, Azul.BLUE), 2)
+        return game.state()
+
+    assert Azul.canonical_state(position(1, {}))[0] == Azul.canonical_state(position(1, swap))[0]
+    assert Azul.canonical_state(position(0, {}))[0] != Azul.canonical_state(position(0, swap))[0]
+
+    key, colors, factories = Azul.canonical_state(position(1, {}))
+    swapped_key, swapped_colors, swapped_factories = Azul.canonical_state(position(1, swap))
+    assert (Azul.canonical_action((Azul.RED, 0, 1), colors, factories)
+            == Azul.canonical_action((Azul.BLUE, 0, 1), swapped_colors, swapped_factories))
+
+def test_state_values_keep_best_action():
+    player = NimAI(seed=0)
+    for seed in range(5):
+        self_play(player, Azul(seed=seed))
+
+    game = Azul(seed=0)
+    rng = random.Random(0)
+    while game.winner is None:
+        state = game.state()
+        actions = Azul.state_actions(state)
+        q_values = [player.get_q_value(state, action) for action in actions]
+        assert player.best_future_reward(state) == max(q_values)
+        assert player.get_q_value(state, player.get_best_action(state)) == max(q_values)
+        assert player.get_best_action(state) in actions
+        game.move(rng.choice(actions))
+
+def test_state_values():
+    values = StateValues([4, 9, 2])
+    assert values.best_value() == 0
+    values.set(9, 1.5)
+    values.set(2, -1)
+    assert values.best_code() == 9
+    values.set(9, -2)
+    assert (values.best_code(), values.best_value()) == (4, 0)
+    assert values.set(7, 3)
+    assert (values.best_code(), values.best_value()) == (7, 3)
+    assert list(values.codes) == [2, 4, 7, 9]
+
+def test_bounded_q_store_lru():
+    store = BoundedQStore(10000, "lru")
+    for key in range(100):
+        store.add(key, [1, 2, 3])
+        store[key, 2] = key
+        assert store.bytes <= 10000
+    assert store.evictions > 0
+    assert store.lookup(99) is not None
+    assert store.lookup(0) is None
+    stats = store.stats()
+    assert stats["entries"] + stats["evictions"] == 100
+    assert stats["values"] == 3 * stats["entries"]
+    assert stats["hit_ratio"] == 0.5
+
+    # Using a state keeps it
+    oldest = next(iter(store.states))
+    store.lookup(oldest)
+    store.add(100, [1])
+    assert store.lookup(oldest) is not None
+
+@pytest.mark.parametrize("eviction, keep", [("visits", "visits"), ("change", "change")])
+def test_bounded_q_store_sampled_eviction(eviction, keep):
+    store = BoundedQStore(20000, eviction)
+    for key in range(20):
+        store.add(key, [1])
+        store[key, 1] = 0
+    for i in range(10):
+        store.lookup(0)
+    store[0, 1] = 10
+    for key in range(20, 400):
+        store.add(key, [1])
+        store[key, 1] = 0
+    assert store.bytes <= 20000
+    assert store.lookup(0) is not None
+    assert len(store.keys) == len(store.states)
+    assert all(store.keys[values.slot] == key for key, values in store.states.items())
+
+def test_training_with_memory_budget():
+    player = train(5, memory_budget=50000, eviction="visits")
+    assert player.q.bytes <= 50000
+    assert player.q.evictions > 0
+
+def test_linear_ai_features():
+    np = pytest.importorskip("numpy")
+    from approximator import action_features, NUM_FEATURES, TAKEN_FEATURE, TAKES_START_FEATURE
+
+    game = Azul(seed=3)
+    actions, features = action_features(game.state())
+    assert actions == game.available_actions(game.boards[game.player], game.factories, game.floor)
+    assert features.shape == (len(actions), NUM_FEATURES)
+    for action, row in zip(actions, features):
+        color, factory, pile = action
+        assert row[TAKEN_FEATURE] * 5 == game.factories[factory].count(color)
+        assert row[TAKES_START_FEATURE] == 0
+
+def test_linear_ai_training():
+    np = pytest.importorskip("numpy")
+    from approximator import LinearAI
+
+    player = LinearAI(seed=0, memory_size=100)
+    assert train(3, player=player) is player
+    assert len(player.memory) == 100
+    assert np.any(player.weights != 0)
+
+    # Batched inference picks the same actions as one state at a time
+    states = [Azul(seed=seed).state() for seed in range(5)]
+    assert player.best_actions(states) == [player.choose_action(state, epsilon=False) for state in states]
+
+def blocked_color_game():
+    """
+    Returns a game without predefined colors where pile 0 of the player to move takes red,
+    but red has no free column in row 0 of the wall. Factory 0 has one red tile.
+    """
+    game = Azul(seed=0, difficulty=1)
+    board = game.boards[game.player]
+    board.place_on_wall(1, Azul.RED, 0)
+    for column, color in zip(range(1, 5), [Azul.BLUE, Azul.YELLOW, Azul.BLACK, Azul.WHITE]):
+        board.place_on_wall(0, color, column)
+    game.factories[0].tiles = 1 << (Azul.RED * 5)
+    return game
+
+def test_linear_ai_difficulty_1():
+    pytest.importorskip("numpy")
+    from approximator import LinearAI, action_features, GAIN_FEATURE
+
+    # A full pile without a column for its color gives no points
+    game = blocked_color_game()
+    actions, features = action_features(game.state(), [(Azul.RED, 0, 0)])
+    assert features[0][GAIN_FEATURE] == 0
+
+    # The walls without predefined colors have more bits than a numpy int
+    player = LinearAI(seed=0)
+    for seed in range(3):
+        game = Azul(seed=seed, difficulty=1)
+        self_play(player, game)
+        assert game.winner is not None
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_mcts_player(batched):
+    if batched:
+        pytest.importorskip("numpy")
+    from mcts import MCTSPlayer
+
+    game = Azul(seed=5)
+    for i in range(10):
+        game.move(random.Random(i).choice(game.available_actions(game.boards[game.player], game.factories, game.floor)))
+    before = full_state(game)
+
+    player = MCTSPlayer(iterations=60, batch_size=16, seed=0, batched=batched)
+    tree = player.search(game)
+    assert full_state(game) == before
+    assert tree.visits[0] == 60
+    children = tree.root_children()
+    assert sum(visits for action, visits, wins in children) == 60
+    assert all(0 <= wins <= visits for action, visits, wins in children)
+    # Every iteration expands at most one node, nodes of the same position share their children
+    tree = player.search(Azul(seed=5))
+    expanded = {tree.first_child[node] for node in range(len(tree)) if tree.child_count[node] > 0}
+    assert len(expanded) <= 60
+    assert {action for action, visits, wins in children} == set(Azul.pruned_actions(game.boards[game.player], game.factories, game.floor))
+    assert game.is_valid_action(player.choose_move(game))
+
+def test_zobrist():
+    for num_players, difficulty in ((2, 0), (3, 1), (4, 0)):
+        game = Azul(num_players, difficulty, seed=num_players)
+        rng = random.Random(num_players)
+        history = []
+        while game.winner is None:
+            actions = Azul.available_actions(game.boards[game.player], game.factories, game.floor)
+            history.append((game.zobrist, game.make_move(rng.choice(actions))))
+            assert game.zobrist == game.compute_zobrist() == Azul.state_zobrist(game.state())
+        for zobrist, undo in reversed(history):
+            game.unmake_move(undo)
+            assert game.zobrist == zobrist
+
+def test_zobrist_transposition():
+    # Taking from factory 0 and then factory 2 gives the same position as the other way around
+    game = Azul(seed=4)
+    other = Azul(seed=4)
+    color0 = game.factories[0].colors()[0]
+    color2 = game.factories[2].colors()[0]
+    color1 = game.factories[1].colors()[0]
+    for action in ((color0, 0, Azul.FLOOR_LINE), (color1, 1, Azul.FLOOR_LINE), (color2, 2, Azul.FLOOR_LINE)):
+        game.move(action)
+    for action in ((color2, 2, Azul.FLOOR_LINE), (color1, 1, Azul.FLOOR_LINE), (color0, 0, Azul.FLOOR_LINE)):
+        other.move(action)
+    assert game.state() == other.state()
+    assert game.zobrist == other.zobrist
+
+def test_transposition_table():
+    table = TranspositionTable(4)
+    assert table.store(1, 3, "deep")
+    assert table.probe(1) == (3, "deep")
+    assert table.probe(5) is None
+    # Key 5 has the same slot as 1 but a lower depth
+    assert not table.store(5, 2, "shallow")
+    assert table.store(5, 3, "other")
+    assert table.probe(1) is None
+    assert table.probe(5) == (3, "other")
+    assert table.stats()["replacements"] == 1
+    table.clear()
+    assert table.probe(5) is None
+
+    player = NimAI(table=TranspositionTable())
+    game = Azul(seed=1)
+    assert game.is_valid_action(player.choose_move(game))
+    assert player.table.probe(game.zobrist)[1] == Azul.canonical_state(game.state())
+
+def minimax_round(game, root_player):
+    scores = [board.score + board.floor_penalty() for board in game.boards]
+    values = []
+    for action in Azul.available_actions(game.boards[game.player], game.factories, game.floor):
+        undo = game.make_move(action)
+        if undo[-1] is not None:
+            scores = [board.score + board.floor_penalty() for board in game.boards]
+            values.append(scores[root_player] - max(s for p, s in enumerate(scores) if p != root_player))
+        else:
+            values.append(minimax_round(game, root_player))
+        game.unmake_move(undo)
+    return max(values) if game.player == root_player else min(values)
+
+def test_endgame_solver():
+    from endgame import EndgameSolver
+
+    solver = EndgameSolver()
+    for seed in range(4):
+        game = Azul(seed=seed)
+        rng = random.Random(seed)
+        while game.tiles_left() > 6:
+            game.move(rng.choice(Azul.available_actions(game.boards[game.player], game.factories, game.floor)))
+        before = full_state(game)
+        action, value, exact = solver.solve(game)
+        assert full_state(game) == before
+        assert exact
+        assert value == minimax_round(game, game.player)
+
+        # The value of the chosen move is the value of the position
+        undo = game.make_move(action)
+        if undo[-1] is None:
+            assert minimax_round(game, 1 - game.player) == value
+        game.unmake_move(undo)
+
+    # Without enough budget for the first iteration there is no answer
+    assert EndgameSolver(max_nodes=1).solve(Azul(seed=0)) == (None, None, False)
+
+def test_endgame_player():
+    from endgame import EndgamePlayer, EndgameSolver
+
+    game = Azul(seed=2)
+    player = EndgamePlayer(NimAI(), max_tiles=6)
+    rng = random.Random(0)
+    while game.tiles_left() > 6:
+        assert player.choose_move(game) == NimAI().choose_move(game)
+        game.move(rng.choice(Azul.available_actions(game.boards[game.player], game.factories, game.floor)))
+    assert player.choose_move(game) == EndgameSolver().solve(game)[0]
+
+def test_immediate_gain_without_column():
+    from arena import GreedyPlayer
+    from endgame import EndgameSolver
+
+    game = blocked_color_game()
+    for factory in game.factories[1:]:
+        factory.tiles = 0
+    assert game.immediate_gain((Azul.RED, 0, 0)) == 0
+    assert game.is_valid_action(GreedyPlayer(seed=0).choose_move(game))
+    action, value, exact = EndgameSolver().solve(game)
+    assert exact and value == minimax_round(game, game.player)
+
+def test_pruned_actions():
+    game = Azul(seed=0)
+    board = game.boards[0]
+    for factory in game.factories:
+        factory.tiles = 0
+    game.factories[1].tiles = game.factories[3].tiles = (2 << (Azul.RED * 5)) + (2 << (Azul.BLUE * 5))
+    game.floor.tiles = 3 << (Azul.RED * 5)
+    board.set_pile(4, Azul.RED, 2)
+
+    actions = Azul.available_actions(board, game.factories, game.floor)
+    pruned = Azul.pruned_actions(board, game.factories, game.floor)
+    assert set(pruned) == {action for action in actions
+                           if action[1] != 3 and not (action[0] == Azul.RED and action[2] == Azul.FLOOR_LINE)}
+    assert (Azul.BLUE, 1, Azul.FLOOR_LINE) in pruned
+    assert Azul.reduction_ratio(board, game.factories, game.floor) == 1 - len(pruned) / len(actions)
+
+    # Red can go to the floor line when the red tile would complete the last row of the wall
+    for column in (0, 2, 3, 4):
+        board.place_on_wall(4, (column - 4) % 5, column)
+    assert (Azul.RED, 1, Azul.FLOOR_LINE) in Azul.pruned_actions(board, game.factories, game.floor)
+
+def test_pruned_actions_keep_center():
+    from endgame import EndgameSolver
+
+    # The center has the same tiles as a factory, but taking from it leaves the other tiles in the center
+    game = Azul(seed=5)
+    for factory in game.factories:
+        factory.tiles = 0
+    game.factories[2].tiles = game.floor.tiles = (2 << (Azul.RED * 5)) + (1 << (Azul.BLUE * 5))
+    board = game.boards[game.player]
+    actions = Azul.available_actions(board, game.factories, game.floor)
+    pruned = Azul.pruned_actions(board, game.factories, game.floor)
+    center = {action for action in actions if action[1] == Azul.FLOOR}
+    assert center and center <= set(pruned)
+
+    action, value, exact = EndgameSolver().solve(game)
+    assert exact and value == minimax_round(game, game.player)
+
+def test_benchmark_compare():
+    from bench import compare
+
+    baseline = {"moves_per_sec": 1000, "q_bytes_per_entry": 20}
+    assert compare({"moves_per_sec": 950, "q_bytes_per_entry": 21, "new": 1}, baseline, 0.1) == []
+    regressions = compare({"moves_per_sec": 800, "q_bytes_per_entry": 30}, baseline, 0.1)
+    assert [(name, round(change, 2)) for name, value, base, change in regressions] == [("moves_per_sec", 0.2), ("q_bytes_per_entry", 0.5)]
+
+def test_training_monitor(tmp_path):
+    from instrumentation import TrainingMonitor
+
+    snapshots = []
+    path = tmp_path / "training.jsonl"
+    monitor = TrainingMonitor(path=str(path), callback=snapshots.append, interval=0)
+    player = train(3, monitor=monitor)
+    # A snapshot after every game and a last one when training stops
+    assert len(snapshots) == 4
+    assert [json.loads(line) for line in path.read_text().splitlines()] == snapshots
+    last = snapshots[-1]
+    assert last["games"] == 3
+    assert last["q_entries"] == len(player.q)
+    assert last["new_q_entries"] == 0
+    assert last["moves"] == last["updates"] and last["average_game_length"] == last["moves"] / 3
+    assert all(seconds > 0 for seconds in last["phase_seconds"].values())
+    assert player.monitor is None
+
+    # Snapshots are rate limited
+    snapshots.clear()
+    train(3, monitor=TrainingMonitor(callback=snapshots.append, interval=3600))
+    assert len(snapshots) == 1
+
+def test_arena():
+    from arena import Arena, GreedyPlayer, RandomPlayer
+
+    arena = Arena({"random": RandomPlayer(), "greedy": GreedyPlayer()}, min_games=20)
+    standings = arena.run(1000)
+    # Greedy always wins, so the ranking is significant as soon as it may be
+    assert arena.games == 20
+    assert [row["name"] for row in standings] == ["greedy", "random"]
+    assert standings[0]["elo_low"] > standings[1]["elo_high"]
+    assert standings[0]["margin_low"] > 0 > standings[1]["margin_high"]
+
+    # 3 players in all seats, with the same results in worker processes
+    agents = {"random": RandomPlayer(), "greedy": GreedyPlayer(), "other": RandomPlayer()}
+    serial = Arena(agents, num_players=3, min_games=1000).run(6)
+    parallel = Arena(agents, num_players=3, workers=2, min_games=1000).run(6)
+    assert serial == parallel
+    assert all(row["games"] == 6 for row in serial)
+
+def test_game_server():
+    import asyncio
+    from arena import GreedyPlayer
+    from server import GameServer
+
+    async def client(port, i):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+        async def send(line):
+            writer.write(line.encode() + b"\n")
+            await writer.drain()
+            return json.loads(await reader.readline())
+
+        assert (await send("state"))["type"] == "error"
+        state = await send(f"new {2 + i % 3} {i} {i % 2}")
+        rng = random.Random(i)
+        while state["winner"] is None:
+            assert state["player"] == state["seat"] == i % 2
+            state = await send("move %d %d %d" % tuple(rng.choice(state["actions"])))
+        assert (await send("move 0 0 0"))["type"] == "error"
+        writer.write(b"quit\n")
+        writer.close()
+        return state
+
+    async def run():
+        server = GameServer(GreedyPlayer(seed=0), max_delay=0.05)
+        tcp_server = await server.start(port=0)
+        port = tcp_server.sockets[0].getsockname()[1]
+        states = await asyncio.gather(*(client(port, i) for i in range(10)))
+        await server.stop(tcp_server)
+        return server, states
+
+    server, states = asyncio.run(run())
+    assert server.games == 10
+    assert all(len(state["boards"]) == 2 + i % 3 for i, state in enumerate(states))
+    # Sessions that wait for the AI at the same time share a batch
+    assert server.batcher.batches < server.batcher.requests
+
+def test_move_batcher_survives_cancelled_moves():
+    import asyncio
+    from server import MoveBatcher
+
+    def policy(games):
+        if "fail" in games:
+            raise RuntimeError("AI failed")
+        return [game.upper() for game in games]
+
+    async def run():
+        batcher = MoveBatcher(policy, max_delay=0.05)
+        batcher.start()
+        for last in ("fail", "ok"):
+            # The client of the first game disconnects while its batch is evaluated
+            gone = asyncio.ensure_future(batcher.choose_move("gone"))
+            waiting = asyncio.ensure_future(batcher.choose_move(last))
+            await asyncio.sleep(0.01)
+            gone.cancel()
+            # A batcher that stopped running would never answer
+            if last == "fail":
+                with pytest.raises(RuntimeError):
+                    await asyncio.wait_for(waiting, 5)
+            else:
+                assert await asyncio.wait_for(waiting, 5) == "OK"
+        await batcher.stop()
+        return batcher
+
+    assert asyncio.run(run()).batches == 2
+
+def test_game_log(tmp_path):
+    from gamelog import GameLogWriter, read_games, train_offline
+
+    path = tmp_path / "games.log"
+    with GameLogWriter(path) as log:
+        online = train(5, seed=2, log=log)
+    assert [record.seed for record in read_games(path)] == [2, 3, 4, 5, 6]
+
+    # Training on the log of a training run gives the same Q-values
+    offline = train_offline([path])
+    assert dict(offline.q.items()) == dict(online.q.items())
+
+    # Replaying a record gives the transitions of playing the game
+    player = NimAI(seed=0)
+    actions = []
+    transitions = self_play(player, Azul(seed=9), learn=False, actions=actions)
+    path = tmp_path / "game.log"
+    with GameLogWriter(path) as log:
+        log.write(9, 2, actions)
+    record = next(read_games(path))
+    assert list(record.actions()) == actions
+    assert list(record.transitions()) == transitions
+    assert record.game().state() == Azul(seed=9).state()
+    *positions, last = record.positions()
+    assert len(positions) == len(actions) and last.winner is not None
+
+    # A record that was cut off is left out
+    with open(path, "ab") as f:
+        f.write(b"\x50\x01")
+    assert len(list(read_games(path))) == 1
+
 def test_has_entire_horizontal_row():
     game = Azul()
     board = game.boards[game.player]
     assert not board.has_entire_horizontal_row()
-    board.wall[0][0] = Azul.BLUE
-    board.wall[0][1] = Azul.RED
-    board.wall[0][2] = Azul.BLACK
-    board.wall[0][3] = Azul.WHITE
+    board.place_on_wall(0, Azul.BLUE)
+    board.place_on_wall(0, Azul.RED)
+    board.place_on_wall(0, Azul.BLACK)
+    board.place_on_wall(0, Azul.WHITE)
     assert not board.has_entire_horizontal_row()
-    board.wall[0][4] = Azul.YELLOW
+    board.place_on_wall(0, Azul.YELLOW)
     assert board.has_entire_horizontal_row()
 
+def test_player_board_wall():
+    board = PlayerBoard()
+    assert board.place_on_wall(1, Azul.BLUE) == 1
+    assert board.wall_color(1, 1) == Azul.BLUE
+    assert board.wall_color(1, 0) == Azul.EMPTY
+    assert board.column_for_color(1, Azul.BLUE) == -1
+    assert board.piles_that_can_receive_color(Azul.BLUE) == [0, 2, 3, 4]
+
+    board = PlayerBoard(difficulty=1)
+    assert board.place_on_wall(0, Azul.RED) == 0
+    assert board.column_for_color(1, Azul.RED) == 1
+    assert board.column_for_color(1, Azul.BLUE) == 0
+
+def test_player_board_foul_tiles():
+    board = PlayerBoard()
+    assert board.add_foul_tiles(Azul.START_PLAYER_TILE, 1) == 0
+    assert board.add_foul_tiles(Azul.RED, 4) == 0
+    assert board.add_foul_tiles(Azul.BLUE, 3) == 1
+    assert board.foul_count() == 7
+    assert board.foul_tile_count(Azul.BLUE) == 2
+    assert board.foul_tile_count(Azul.START_PLAYER_TILE) == 1
+
+def test_player_board_copy():
+    board = PlayerBoard()
+    board.save_tiles_to_pile(2, Azul.RED, 2)
+    board.place_on_wall(3, Azul.WHITE)
+    copy = board.copy()
+    assert copy == board and hash(copy) == hash(board)
+    copy.save_tiles_to_pile(2, Azul.RED, 1)
+    assert copy != board
+    assert board.pile(2) == (Azul.RED, 2)
+
 # def test_best_future_reward():
     # ai = NimAI()
     # assert ai.best_future_reward([1,3,5,7]) == 0